@@ -0,0 +1,251 @@
+#! /usr/bin/env python3
+
+# Runs the flashing paths of usb_update.py against the simulated Precursor in usb_sim.py and
+# reports how many USB control transfers and how much simulated time each one takes per MiB.
+# Simulated time comes from the per-operation latencies in usb_sim.DEFAULT_LATENCY (override
+# them with --latency), so the numbers are repeatable from run to run and host to host.
+#
+# Save a run with --json, and check a later one against it with --baseline to catch
+# throughput regressions before they reach the provisioning line.
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import usb_sim
+import usb_update
+
+LOC_KERNEL = 0x0098_0000
+
+def make_device(args):
+    if args.csr != None:
+        sim = usb_sim.SimulatedPrecursor.from_csv_file(args.csr, latency=args.latency, wdt_timeout=args.wdt_timeout)
+    else:
+        sim = usb_sim.SimulatedPrecursor(latency=args.latency, wdt_timeout=args.wdt_timeout)
+    pc_usb = sim.attach(usb_update.PrecursorUsb(sim))
+    pc_usb.quiet_progress = True
+    return (sim, pc_usb)
+
+# a scenario is (name, bytes moved, setup, run, check); setup and check may be None
+def scenarios(size, seed):
+    rng = random.Random(seed)
+    image = rng.randbytes(size)
+    half_blank = image[:size // 2] + b'\xff' * (size - size // 2)
+    changed = bytearray(image)
+    for i in range(0, size, 100 * 4096):
+        changed[i] ^= 0xff
+
+    def programmed(expected):
+        def check(sim, pc_usb):
+            return sim.flash[LOC_KERNEL:LOC_KERNEL + len(expected)] == expected
+        return check
+
+    def preload(data):
+        def setup(sim, pc_usb):
+            sim.flash[LOC_KERNEL:LOC_KERNEL + len(data)] = data
+        return setup
+
+    def sampled(sim, pc_usb):
+        pc_usb.verify_sample = 0.1
+        pc_usb.verify_seed = seed
+
+    return [
+        ('load_csrs', 0x8000, None,
+            lambda sim, pc_usb: pc_usb.load_csrs(use_cache=False), None),
+        ('load_csrs cached', 0x40, lambda sim, pc_usb: pc_usb.load_csrs(),
+            lambda sim, pc_usb: pc_usb.load_csrs(), None),
+        ('burst_read', size, preload(image),
+            lambda sim, pc_usb: pc_usb.burst_read(sim.flash_base + LOC_KERNEL, size),
+            None),
+        ('erase_region', size, preload(image),
+            lambda sim, pc_usb: pc_usb.erase_region(LOC_KERNEL, size),
+            lambda sim, pc_usb: usb_update.is_erased(sim.flash[LOC_KERNEL:LOC_KERNEL + size])),
+        ('flash_program', size, None,
+            lambda sim, pc_usb: pc_usb.flash_program(LOC_KERNEL, image, verify=False),
+            programmed(image)),
+        ('flash_program verify', size, None,
+            lambda sim, pc_usb: pc_usb.flash_program(LOC_KERNEL, image, verify=True),
+            programmed(image)),
+        ('flash_program sampled', size, sampled,
+            lambda sim, pc_usb: pc_usb.flash_program(LOC_KERNEL, image, verify=True),
+            programmed(image)),
+        ('flash_program half blank', size, None,
+            lambda sim, pc_usb: pc_usb.flash_program(LOC_KERNEL, half_blank, verify=False),
+            programmed(half_blank)),
+        ('flash_program delta same', size, preload(image),
+            lambda sim, pc_usb: pc_usb.flash_program(LOC_KERNEL, image, verify=False, delta=True),
+            programmed(image)),
+        ('flash_program delta 1%', size, preload(image),
+            lambda sim, pc_usb: pc_usb.flash_program(LOC_KERNEL, bytes(changed), verify=False, delta=True),
+            programmed(bytes(changed))),
+        ('flash_program delta 1% verify', size, preload(image),
+            lambda sim, pc_usb: pc_usb.flash_program(LOC_KERNEL, bytes(changed), verify=True, delta=True),
+            programmed(bytes(changed))),
+    ]
+
+def run_scenario(args, name, nbytes, setup, run, check):
+    (sim, pc_usb) = make_device(args)
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        if name.startswith('load_csrs') == False:
+            pc_usb.load_csrs()
+        if setup != None:
+            setup(sim, pc_usb)
+        transfers = sum(sim.transfers.values())
+        start = sim.clock.now()
+        wall = time.perf_counter()
+        try:
+            run(sim, pc_usb)
+            failed = None
+        except SystemExit as e:
+            failed = "exited with {}".format(e.code)
+        wall = time.perf_counter() - wall
+    transfers = sum(sim.transfers.values()) - transfers
+    seconds = sim.clock.now() - start
+    if failed == None and check != None and not check(sim, pc_usb):
+        failed = "flash contents don't match"
+    if failed == None and len(sim.violations) > 0:
+        failed = "protocol violation: " + sim.violations[0]
+    mib = max(nbytes, 1) / (1024 * 1024)
+    return {
+        'name': name,
+        'bytes': nbytes,
+        'transfers': transfers,
+        'sim_seconds': seconds,
+        'transfers_per_mib': transfers / mib,
+        'sim_seconds_per_mib': seconds / mib,
+        'wdt_trips': sim.wdt_trips,
+        'wall_seconds': wall,
+        'failed': failed,
+        'log': log.getvalue() if failed != None else None,
+    }
+
+# Wall-clock start-up cost of a fresh process, which is what shell loops of --peek pay per call:
+# the bare interpreter, importing usb_update, and parsing a command line. Median of `runs`, in ms.
+def measure_startup(runs):
+    here = os.path.dirname(os.path.abspath(__file__))
+    commands = [
+        ('python', ['-c', 'pass']),
+        ('import usb_update', ['-c', 'import usb_update']),
+        ('usb_update.py --help', [os.path.join(here, 'usb_update.py'), '--help']),
+    ]
+    startup = {}
+    for (name, argv) in commands:
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable] + argv, cwd=here, stdout=subprocess.DEVNULL, check=True)
+            times.append(time.perf_counter() - start)
+        startup[name] = statistics.median(times) * 1000
+    return startup
+
+def print_table(results):
+    print("{:28} {:>10} {:>11} {:>11} {:>10} {:>10} {:>5}".format(
+        'scenario', 'transfers', 'xfers/MiB', 'sim s', 'sim s/MiB', 'wall s', 'wdt'))
+    for r in results:
+        print("{:28} {:>10} {:>11.0f} {:>11.3f} {:>10.3f} {:>10.2f} {:>5}{}".format(
+            r['name'], r['transfers'], r['transfers_per_mib'], r['sim_seconds'], r['sim_seconds_per_mib'],
+            r['wall_seconds'], r['wdt_trips'], '' if r['failed'] == None else '  FAILED: ' + r['failed']))
+
+# returns a list of complaints about results that got worse than the baseline by more than `tolerance`
+def compare(results, baseline, tolerance):
+    previous = {r['name']: r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        old = previous.get(r['name'])
+        if old == None:
+            continue
+        for key in ('transfers', 'sim_seconds'):
+            if old[key] > 0 and r[key] > old[key] * (1 + tolerance):
+                regressions.append("{}: {} went from {:.3f} to {:.3f}".format(r['name'], key, old[key], r[key]))
+    return regressions
+
+def parse_latency(specs):
+    latency = {}
+    for spec in specs or []:
+        (key, value) = spec.split('=', 1)
+        if key not in usb_sim.DEFAULT_LATENCY:
+            raise argparse.ArgumentTypeError("unknown latency '{}'".format(key))
+        latency[key] = float(value)
+    return latency
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark usb_update.py flashing against a simulated Precursor")
+    parser.add_argument(
+        "--size", help="Image size for the flash scenarios, in KiB (default 1024)", type=int, default=1024
+    )
+    parser.add_argument(
+        "--csr", required=False, help="Build the simulated CSR space from this csr.csv instead of the built-in one", type=str
+    )
+    parser.add_argument(
+        "--latency", required=False, help="Override a simulated latency in seconds, e.g. xfer=0.001 or be=0.3. May be repeated.", action='append', metavar=('NAME=SECONDS')
+    )
+    parser.add_argument(
+        "--wdt-timeout", required=False, help="Count a watchdog trip whenever pings are further apart than this many simulated seconds", type=float
+    )
+    parser.add_argument(
+        "--only", required=False, help="Only run scenarios whose name contains this string", type=str
+    )
+    parser.add_argument(
+        "--seed", help="Seed for the generated images", type=int, default=0
+    )
+    parser.add_argument(
+        "--startup-runs", help="Times to start each process for the start-up measurement; 0 skips it (default 5)", type=int, default=5
+    )
+    parser.add_argument(
+        "--json", required=False, help="Save the results to this file", type=str
+    )
+    parser.add_argument(
+        "--baseline", required=False, help="Fail if transfers or simulated time regressed against a previous --json file", type=str
+    )
+    parser.add_argument(
+        "--tolerance", help="Allowed regression against --baseline, as a fraction (default 0.02)", type=float, default=0.02
+    )
+    args = parser.parse_args()
+    args.latency = parse_latency(args.latency)
+
+    # keep the CSR cache and progress journals of the runs away from the real ones
+    cache = tempfile.TemporaryDirectory()
+    os.environ['XDG_CACHE_HOME'] = cache.name
+
+    results = []
+    for (name, nbytes, setup, run, check) in scenarios(args.size * 1024, args.seed):
+        if args.only != None and args.only not in name:
+            continue
+        results.append(run_scenario(args, name, nbytes, setup, run, check))
+    print_table(results)
+    startup = None
+    if args.startup_runs > 0:
+        startup = measure_startup(args.startup_runs)
+        print("\nProcess start-up (median of {}, wall clock):".format(args.startup_runs))
+        for (name, ms) in startup.items():
+            print("  {:26} {:8.1f} ms".format(name, ms))
+
+    status = 0
+    for r in results:
+        if r['failed'] != None:
+            print("\n{} failed, its output was:\n{}".format(r['name'], r['log']))
+            status = 1
+    if args.json != None:
+        with open(args.json, "w") as f:
+            json.dump({'size': args.size * 1024, 'latency': args.latency, 'results': results, 'startup': startup}, f, indent=2)
+            f.write('\n')
+    if args.baseline != None:
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print("Regression: " + line)
+        if len(regressions) > 0:
+            status = 1
+    exit(status)
+
+if __name__ == "__main__":
+    main()
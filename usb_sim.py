@@ -0,0 +1,343 @@
+#! /usr/bin/env python3
+
+# Software stand-in for a Precursor attached over USB, for exercising usb_update.py
+# without hardware. SimulatedPrecursor implements enough of the pyusb Device interface
+# (ctrl_transfer, set_configuration, bus/port identification) that PrecursorUsb can be
+# constructed against it directly. Behind the vendor request protocol it models:
+#
+#  - a CSR space built from a csr.csv (the real one from a build, or a trimmed default),
+#    with the descriptor stored in flash at LOC_CSRCSV just like the gateware does
+#  - the SPINOR command interface, with an MX66UM-style NOR array behind it: erases set
+#    bits, page programs can only clear them, and WIP/WEL behave as on the real part
+#  - per-operation latencies on a virtual clock, so runs are fast and repeatable
+#
+# Protocol misuse (erasing without WEL, issuing commands while WIP, ...) doesn't raise;
+# it is logged to `violations` so a benchmark or test can assert there was none.
+
+import array
+import hashlib
+import threading
+
+LOC_CSRCSV = 0x20277000
+FLASH_BASE = 0x2000_0000
+FLASH_LEN = 0x800_0000
+CSR_BASE = 0xF000_0000
+
+# the registers and regions usb_update.py touches, laid out like a v0.9 build
+DEFAULT_CSR_CSV = """#--------------------------------------------------------------------------------
+# Auto-generated by LiteX
+#--------------------------------------------------------------------------------
+csr_base,reboot,0xf0000000,,
+csr_base,spinor,0xf0001000,,
+csr_base,wdt,0xf0002000,,
+csr_register,reboot_soc_reset,0xf0000000,1,rw
+csr_register,reboot_addr,0xf0000004,1,rw
+csr_register,reboot_cpu_hold_reset,0xf0000008,1,rw
+csr_register,spinor_config,0xf0001000,1,rw
+csr_register,spinor_delay_config,0xf0001004,1,rw
+csr_register,spinor_delay_status,0xf0001008,1,ro
+csr_register,spinor_command,0xf000100c,1,rw
+csr_register,spinor_cmd_arg,0xf0001010,1,rw
+csr_register,spinor_cmd_rbk_data,0xf0001014,1,ro
+csr_register,spinor_status,0xf0001018,1,ro
+csr_register,spinor_wdata,0xf000101c,1,rw
+csr_register,spinor_ev_status,0xf0001020,1,ro
+csr_register,spinor_ev_pending,0xf0001024,1,rw
+csr_register,spinor_ev_enable,0xf0001028,1,rw
+csr_register,wdt_watchdog,0xf0002000,1,rw
+csr_register,wdt_period,0xf0002004,1,rw
+csr_register,wdt_state,0xf0002008,1,ro
+git_rev,v0.9.8-sim,,,
+memory_region,sram,0x10000000,2097152,cached
+memory_region,spiflash,0x20000000,134217728,io
+memory_region,vexriscv_debug,0xefff0000,256,io
+"""
+
+# per-operation busy times in seconds, roughly the MX66UM1G45G typicals
+DEFAULT_LATENCY = {
+    'xfer': 0.0005,          # fixed cost of one control transfer
+    'byte': 1.0 / 1_000_000, # per payload byte
+    'se': 0.025,
+    'be32': 0.14,
+    'be': 0.22,
+    'pp': 0.00015,
+    'ce': 300.0,
+}
+
+# time only moves when a transfer is made or the host sleeps; the lock keeps a pipelined
+# transfer thread and a sleeping host from losing each other's updates
+class VirtualClock:
+    def __init__(self):
+        self.t = 0.0
+        self.lock = threading.Lock()
+
+    def now(self):
+        return self.t
+
+    def sleep(self, dt):
+        if dt > 0:
+            with self.lock:
+                self.t += dt
+
+def make_descriptor(csv_text):
+    body = csv_text.encode('utf-8')
+    blob = bytearray(len(body).to_bytes(4, 'little') + body)
+    if len(blob) > 0x7FC0:
+        raise ValueError("csr.csv too large for the descriptor area")
+    blob += bytearray(0x7FC0 - len(blob))
+    blob += hashlib.sha512(blob).digest()
+    return blob
+
+def parse_csrs(csv_text):
+    registers = {}
+    regions = {}
+    for line in csv_text.split('\n'):
+        if line.startswith('#'):
+            continue
+        row = line.split(',')
+        if len(row) > 1:
+            if 'csr_register' in row[0]:
+                registers[row[1]] = int(row[2], 0)
+            if 'memory_region' in row[0]:
+                regions[row[1]] = (int(row[2], 0), int(row[3], 0))
+    return registers, regions
+
+# the part of a pyusb device's private context that usb.util.dispose_resources() calls
+class SimulatedContext:
+    def dispose(self, device, close_handle=True):
+        pass
+
+class SimulatedPrecursor:
+    RDSR = 0x05
+    RDSCUR = 0x2B
+    RDID = 0x9F
+    WREN = 0x06
+    WRDI = 0x04
+    SE4B = 0x21
+    BE32K4B = 0x5C
+    BE4B = 0xDC
+    PP4B = 0x12
+    CE = 0x60
+
+    # `locked` lists flash ranges (offsets) that read back as zeros, like the gateware area
+    # `wdt_timeout`, if set, counts a watchdog trip whenever pings are further apart than that
+    def __init__(self, csr_csv=None, latency=None, clock=None, locked=((0, LOC_CSRCSV - FLASH_BASE),),
+                 wdt_timeout=None, bus=1, port_numbers=(1,), serial_number='sim0'):
+        if csr_csv is None:
+            csr_csv = DEFAULT_CSR_CSV
+        self.csr_csv = csr_csv
+        self.registers, self.regions = parse_csrs(csr_csv)
+        self.names = {v: k for k, v in self.registers.items()}
+        self.flash_base, self.flash_len = self.regions['spiflash']
+        self.flash = bytearray(b'\xff') * self.flash_len
+        desc = make_descriptor(csr_csv)
+        off = LOC_CSRCSV - self.flash_base
+        self.flash[off:off + len(desc)] = desc
+        self.locked = list(locked)
+        self.latency = dict(DEFAULT_LATENCY)
+        if latency is not None:
+            self.latency.update(latency)
+        self.clock = clock if clock is not None else VirtualClock()
+        self.csr = {}
+        self.ram = {}
+        self.page_buf = bytearray()
+        self.status = 0
+        self.busy_until = 0.0
+        self.scur = 0
+        self.rbk = 0
+        self.wdt_timeout = wdt_timeout
+        self.last_ping = self.clock.now()
+        self.wdt_trips = 0
+        self.resets = 0
+        self.bus = bus
+        self.port_numbers = port_numbers
+        self.serial_number = serial_number
+        self.address = 1
+        self.idProduct = 0x5bf0
+        self.idVendor = 0x1209
+        self.transfers = {'in': 0, 'out': 0}
+        self.bytes = {'in': 0, 'out': 0}
+        self.commands = {}
+        self.violations = []
+        self.configured = False
+        self._ctx = SimulatedContext()
+
+    @classmethod
+    def from_csv_file(cls, fname, **kwargs):
+        with open(fname, "r") as f:
+            return cls(csr_csv=f.read(), **kwargs)
+
+    # hooks a PrecursorUsb up to this device's virtual clock
+    def attach(self, pc_usb):
+        pc_usb.use_clock(self.clock.now, self.clock.sleep)
+        return pc_usb
+
+    # --- pyusb Device surface ---
+    def set_configuration(self, configuration=None):
+        self.configured = True
+
+    def get_active_configuration(self):
+        return "<simulated configuration>"
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0, data_or_wLength=None, timeout=None):
+        addr = (wIndex << 16) | wValue
+        if bmRequestType & 0x80:
+            if isinstance(data_or_wLength, int):
+                buf = array.array('B', bytes(data_or_wLength))
+                ret_buf = True
+            else:
+                buf = data_or_wLength
+                ret_buf = False
+            self._advance(len(buf))
+            self.transfers['in'] += 1
+            self.bytes['in'] += len(buf)
+            data = self.read(addr, len(buf))
+            buf[:] = array.array('B', data)
+            return buf if ret_buf else len(buf)
+        else:
+            data = bytes(data_or_wLength)
+            self._advance(len(data))
+            self.transfers['out'] += 1
+            self.bytes['out'] += len(data)
+            self.write(addr, data)
+            return len(data)
+
+    # --- memory map ---
+    def _advance(self, nbytes):
+        self.clock.sleep(self.latency['xfer'] + nbytes * self.latency['byte'])
+        if self.wdt_timeout is not None and self.clock.now() - self.last_ping > self.wdt_timeout:
+            self.wdt_trips += 1
+            self.last_ping = self.clock.now()
+
+    def _in_flash(self, addr):
+        return self.flash_base <= addr < self.flash_base + self.flash_len
+
+    def read(self, addr, length):
+        if self._in_flash(addr):
+            off = addr - self.flash_base
+            data = bytearray(self.flash[off:off + length])
+            for (lo, hi) in self.locked:
+                s = max(lo, off)
+                e = min(hi, off + length)
+                if s < e:
+                    data[s - off:e - off] = bytes(e - s)
+            return bytes(data)
+        if addr >= CSR_BASE:
+            out = bytearray()
+            for a in range(addr, addr + length, 4):
+                out += self._csr_read(a & ~3).to_bytes(4, 'little')
+            return bytes(out[:length])
+        return bytes(self.ram.get(a, 0) for a in range(addr, addr + length))
+
+    def write(self, addr, data):
+        if self._in_flash(addr):
+            # the page write responder aggregates any write into the SPINOR range
+            self.page_buf += data
+            return
+        if addr >= CSR_BASE:
+            for i in range(0, len(data), 4):
+                word = int.from_bytes(data[i:i + 4].ljust(4, b'\0'), 'little')
+                self._csr_write(addr + i, word)
+            return
+        for i, b in enumerate(data):
+            self.ram[addr + i] = b
+
+    def _csr_read(self, addr):
+        name = self.names.get(addr)
+        if name == 'spinor_cmd_rbk_data':
+            return self.rbk
+        if name == 'spinor_status':
+            self._update_status()
+            return self.status
+        return self.csr.get(addr, 0)
+
+    def _csr_write(self, addr, value):
+        name = self.names.get(addr)
+        self.csr[addr] = value
+        if name == 'spinor_command' and (value & 0x2):
+            self._spinor_exec(value)
+        elif name == 'reboot_soc_reset' and value == 0xac:
+            self.reset()
+        elif name == 'wdt_watchdog':
+            self.last_ping = self.clock.now()
+        elif name == 'spinor_wdata':
+            self.page_buf += value.to_bytes(4, 'little')
+
+    # the SoC comes back out of reset with fresh CSRs and re-enumerates under a new address
+    def reset(self):
+        self.csr = {}
+        self.page_buf = bytearray()
+        self.status &= ~0x02
+        self.address += 1
+        self.resets += 1
+        self.last_ping = self.clock.now()
+
+    # --- SPI NOR model ---
+    def _update_status(self):
+        if self.status & 0x01 and self.clock.now() >= self.busy_until:
+            self.status &= ~0x03
+
+    def _busy(self, op):
+        self.status |= 0x01
+        self.busy_until = self.clock.now() + self.latency[op]
+
+    def _violation(self, msg):
+        self.violations.append("{:.6f}: {}".format(self.clock.now(), msg))
+
+    def _erase(self, addr, size, op):
+        if not self.status & 0x02:
+            self._violation("erase at 0x{:08x} without WEL".format(addr))
+            return
+        base = addr & ~(size - 1)
+        self.flash[base:base + size] = b'\xff' * size
+        self._busy(op)
+
+    def _spinor_exec(self, value):
+        cmd = (value >> 2) & 0xff
+        data_words = (value >> 16) & 0xff
+        arg = self.csr.get(self.registers['spinor_cmd_arg'], 0)
+        self.commands[cmd] = self.commands.get(cmd, 0) + 1
+        self._update_status()
+        if cmd == self.RDSR:
+            self.rbk = (self.status & 0xff) | ((self.status & 0xff) << 8)
+            return
+        if cmd == self.RDSCUR:
+            self.rbk = self.scur | (self.scur << 8)
+            return
+        if cmd == self.RDID:
+            self.rbk = 0x8080c2c2 if data_words == 1 else 0x3b3b8080
+            return
+        if self.status & 0x01:
+            # the part ignores everything but status reads while busy; a WREN retried until
+            # WEL sticks is fine, but a lost erase or program is a host bug
+            if cmd not in (self.WREN, self.WRDI):
+                self._violation("command 0x{:02x} issued while WIP".format(cmd))
+            return
+        if cmd == self.WREN:
+            self.status |= 0x02
+        elif cmd == self.WRDI:
+            self.status &= ~0x02
+        elif cmd == self.SE4B:
+            self._erase(arg, 0x1000, 'se')
+        elif cmd == self.BE32K4B:
+            self._erase(arg, 0x8000, 'be32')
+        elif cmd == self.BE4B:
+            self._erase(arg, 0x10000, 'be')
+        elif cmd == self.CE:
+            self._erase(0, self.flash_len, 'ce')
+        elif cmd == self.PP4B:
+            nbytes = data_words * 2
+            data = self.page_buf[:nbytes]
+            self.page_buf = bytearray()
+            if not self.status & 0x02:
+                self._violation("page program at 0x{:08x} without WEL".format(arg))
+                return
+            if len(data) < nbytes:
+                self._violation("page program at 0x{:08x} with short buffer".format(arg))
+            page = arg & ~0xff
+            for i, b in enumerate(data):
+                a = page + ((arg + i) & 0xff)
+                self.flash[a] &= b
+            self._busy('pp')
+        else:
+            self._violation("unknown command 0x{:02x}".format(cmd))
@@ -1,16 +1,86 @@
 #! /usr/bin/env python3
 
 import argparse
+import contextlib
+import functools
 
 import usb.core
 import usb.util
 import array
 import sys
-import hashlib
-import csv
-import urllib.request
+import os
+import io
+import mmap
+import stat
+import time
+import json
+import threading
+
+# Everything else (progressbar, hashlib, csv, urllib.request, ...) is imported by the code that
+# needs it, so that a --peek or --poke doesn't pay for modules it never uses.
+
+# bump whenever the layout of the cached CSR database changes
+CSR_CACHE_VERSION = 2
+
+# host-side state (parsed CSR descriptors etc.) lives under $XDG_CACHE_HOME/precursor-usb
+def cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'precursor-usb')
+
+# charges the time spent in a PrecursorUsb method to the named RunStats phase
+def phase(name):
+    def wrap(fn):
+        @functools.wraps(fn)
+        def timed(self, *args, **kwargs):
+            with self.stats.phase(name):
+                return fn(self, *args, **kwargs)
+        return timed
+    return wrap
+
+# Transfer counts and per-phase timing for one device. Phases nest, and time is charged to
+# the innermost one only, so the phase totals add up to the instrumented wall time.
+class RunStats:
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.transfers = {} # kind -> [count, bytes, seconds]
+        self.phases = {} # name -> seconds
+        self.images = []
+        self.stack = []
+        self.started = self.clock()
+
+    def transfer(self, kind, nbytes, seconds):
+        entry = self.transfers.setdefault(kind, [0, 0, 0.0])
+        entry[0] += 1
+        entry[1] += nbytes
+        entry[2] += seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        now = self.clock()
+        if len(self.stack) > 0:
+            (outer, since) = self.stack[-1]
+            self.phases[outer] = self.phases.get(outer, 0.0) + now - since
+        self.stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = self.clock()
+            (_, since) = self.stack.pop()
+            self.phases[name] = self.phases.get(name, 0.0) + now - since
+            if len(self.stack) > 0:
+                self.stack[-1][1] = now
+
+    def report(self):
+        return {
+            'seconds': self.clock() - self.started,
+            'transfers': {kind: {'count': c, 'bytes': b, 'seconds': s} for (kind, (c, b, s)) in self.transfers.items()},
+            'phases': dict(self.phases),
+            'images': self.images,
+        }
 
-from progressbar.bar import ProgressBar
+    def print_summary(self):
+        print("USB transfers: " + ", ".join("{} {}".format(kind, c) for (kind, (c, b, s)) in sorted(self.transfers.items())))
+        print("Time by phase: " + ", ".join("{} {:.2f}s".format(name, s) for (name, s) in sorted(self.phases.items())))
 
 class PrecursorUsb:
     def __init__(self, dev):
@@ -21,13 +91,60 @@ class PrecursorUsb:
         self.WREN = 0x06
         self.WRDI = 0x04
         self.SE4B = 0x21
+        self.BE32K4B = 0x5C
         self.BE4B = 0xDC
         self.PP4B = 0x12
+        self.CE = 0x60
+        # MX66UM1G45G (typical, maximum) busy times in seconds, per the datasheet
+        self.TIMING = {
+            'pp': (0.00015, 0.00075),
+            'se': (0.025, 0.4),
+            'be32': (0.14, 1.0),
+            'be': (0.22, 2.0),
+            'ce': (300.0, 600.0),
+        }
+        # erase granularities the part supports, largest first
+        self.ERASE_SIZES = [0x1_0000, 0x8000, 0x1000]
+        self.poll_timeout = None # seconds; None means twice the datasheet maximum
+        # bytes per burst_read/burst_write control transfer, and the timeout of each transfer
+        # in ms; --tune measures the best size for this host and gateware and saves both
+        self.transfer_size = 4096
+        self.transfer_timeout = 500
+        self.transfer_ms = 1.0 # rough cost of one transfer of that size, for time estimates
+        # sizes --tune tries; a control transfer's wLength is 16 bits
+        self.TUNE_SIZES = [512, 1024, 2048, 4096, 8192, 16384, 32768]
+        # fraction of pages to read back when verifying; None checks everything
+        self.verify_sample = None
+        self.verify_seed = None
+        # pick up an interrupted flash_program of the same image where its journal left off
+        self.resume = False
+        self.poll_stats = {}
+        # host-side timing; the simulator swaps in its virtual clock through use_clock()
+        self.clock = time.monotonic
+        self.sleep = time.sleep
+        self.stats = RunStats(self.clock)
+        # write-only command registers whose last written value is remembered, so a
+        # write of the same value again can be elided. Never the command or watchdog
+        # registers: writing those has side effects even when the value repeats.
+        self.SHADOWED = ['spinor_cmd_arg']
+        self.shadow = {}
+        self.shadow_addrs = set()
+        self.elided_writes = 0
+        self.halted = False # set by halt(), cleared by unhalt() and reset_soc()
+        self.quiet_progress = False # line-based progress, for when several devices share a console
+        # Once the CSRs are loaded, transfer() pings the watchdog whenever this many seconds have
+        # passed since the last ping, rather than callers pinging before every block and page.
+        self.wdt_interval = 0.5
+        self.wdt_due = None # clock() time the next ping is due
         self.registers = {}
+        self.register_sizes = {} # in 32-bit words
+        self.csr_addrs = {}
         self.regions = {}
         self.gitrev = ''
 
     def halt(self):
+        self.shadow_invalidate()
+        self.halted = True
         if 'vexriscv_debug' in self.regions:
             self.poke(int(self.regions['vexriscv_debug'][0], 0), 0x00020000)
         elif 'reboot_cpu_hold_reset' in self.registers:
@@ -36,6 +153,9 @@ class PrecursorUsb:
             print("Can't find reset CSR. Try updating to the latest version of this program")
 
     def unhalt(self):
+        # once the CPU runs it may reprogram the SPINOR controller behind our back
+        self.shadow_invalidate()
+        self.halted = False
         if 'vexriscv_debug' in self.regions:
             self.poke(int(self.regions['vexriscv_debug'][0], 0), 0x02000000)
         elif 'reboot_cpu_hold_reset' in self.registers:
@@ -43,16 +163,48 @@ class PrecursorUsb:
         else:
             print("Can't find reset CSR. Try updating to the latest version of this program")
 
+    def reset_soc(self):
+        self.shadow_invalidate()
+        self.halted = False
+        self.wdt_due = None
+        try:
+            self.poke(self.register('reboot_soc_reset'), 0xac, display=False)
+        except usb.core.USBError:
+            pass # we expect an error because we reset the SOC and that includes the USB core
+
+    def use_clock(self, clock, sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.stats = RunStats(clock)
+
+    def progress_bar(self, max_value, prefix):
+        if self.quiet_progress:
+            return StepProgress(max_value, prefix).start()
+        from progressbar.bar import ProgressBar
+        return ProgressBar(min_value=0, max_value=max_value, prefix=prefix).start()
+
     def register(self, name):
-        return int(self.registers[name], 0)
+        return self.csr_addrs[name]
+
+    def shadow_invalidate(self):
+        self.shadow = {}
+
+    # every vendor request goes through here, so it can be counted and timed by `kind`, and so the
+    # watchdog gets pinged whenever it's due
+    def transfer(self, kind, bmRequestType, addr, data):
+        self.keepalive()
+        start = self.clock()
+        ret = self.dev.ctrl_transfer(bmRequestType=bmRequestType, bRequest=0,
+            wValue=(addr & 0xffff), wIndex=((addr >> 16) & 0xffff),
+            data_or_wLength=data, timeout=self.transfer_timeout)
+        self.stats.transfer(kind, len(data), self.clock() - start)
+        return ret
 
     def peek(self, addr, display=False):
         _dummy_s = '\x00'.encode('utf-8')
         data = array.array('B', _dummy_s * 4)
 
-        numread = self.dev.ctrl_transfer(bmRequestType=(0x80 | 0x43), bRequest=0,
-        wValue=(addr & 0xffff), wIndex=((addr >> 16) & 0xffff),
-        data_or_wLength=data, timeout=500)
+        numread = self.transfer('peek', 0x80 | 0x43, addr, data)
 
         read_data = int.from_bytes(data.tobytes(), byteorder='little', signed=False)
         if display == True:
@@ -64,64 +216,123 @@ class PrecursorUsb:
             _dummy_s = '\x00'.encode('utf-8')
             data = array.array('B', _dummy_s * 4)
 
-            numread = self.dev.ctrl_transfer(bmRequestType=(0x80 | 0x43), bRequest=0,
-            wValue=(addr & 0xffff), wIndex=((addr >> 16) & 0xffff),
-            data_or_wLength=data, timeout=500)
+            numread = self.transfer('peek', 0x80 | 0x43, addr, data)
 
             read_data = int.from_bytes(data.tobytes(), byteorder='little', signed=False)
             print("before poke: 0x{:08x}".format(read_data))
 
+        shadowed = addr in self.shadow_addrs
+        if shadowed:
+            if check == False and self.shadow.get(addr) == wdata:
+                self.elided_writes += 1
+                if display == True:
+                    print("wrote 0x{:08x} to 0x{:08x}".format(wdata, addr))
+                return
+            # forget the old value first, in case the transfer fails part way
+            self.shadow.pop(addr, None)
+
         data = array.array('B', wdata.to_bytes(4, 'little'))
-        numwritten = self.dev.ctrl_transfer(bmRequestType=(0x00 | 0x43), bRequest=0,
-            wValue=(addr & 0xffff), wIndex=((addr >> 16) & 0xffff),
-            data_or_wLength=data, timeout=500)
+        numwritten = self.transfer('poke', 0x00 | 0x43, addr, data)
+        if shadowed:
+            self.shadow[addr] = wdata
 
         if check == True:
             _dummy_s = '\x00'.encode('utf-8')
             data = array.array('B', _dummy_s * 4)
 
-            numread = self.dev.ctrl_transfer(bmRequestType=(0x80 | 0x43), bRequest=0,
-            wValue=(addr & 0xffff), wIndex=((addr >> 16) & 0xffff),
-            data_or_wLength=data, timeout=500)
+            numread = self.transfer('peek', 0x80 | 0x43, addr, data)
 
             read_data = int.from_bytes(data.tobytes(), byteorder='little', signed=False)
             print("after poke: 0x{:08x}".format(read_data))
         if display == True:
             print("wrote 0x{:08x} to 0x{:08x}".format(wdata, addr))
 
-    def burst_read(self, addr, len):
-        _dummy_s = '\x00'.encode('utf-8')
-        maxlen = 4096
-
-        ret = bytearray()
-        packet_count = len // maxlen
-        if (len % maxlen) != 0:
+    # Reads the 32-bit words at `addrs` with one burst_read per run of consecutive addresses,
+    # rather than a peek for each. Returns {addr: value}.
+    def peek_many(self, addrs):
+        values = {}
+        for (start, count) in word_runs(addrs, self.transfer_size // 4):
+            data = self.burst_read(start, count * 4)
+            for i in range(count):
+                values[start + i * 4] = int.from_bytes(data[i * 4:i * 4 + 4], 'little')
+        return values
+
+    # Writes {addr: value} with one burst_write per run of consecutive addresses
+    def poke_many(self, writes):
+        for (start, count) in word_runs(writes.keys(), self.transfer_size // 4):
+            data = b''.join(writes[start + i * 4].to_bytes(4, 'little') for i in range(count))
+            for i in range(count):
+                self.shadow.pop(start + i * 4, None)
+            self.burst_write(start, data, in_place=True)
+        for (addr, value) in writes.items():
+            if addr in self.shadow_addrs:
+                self.shadow[addr] = value
+
+    # Reads every register in the CSR database, coalesced by peek_many, and returns
+    # {name: hex string}. Multi-word registers are put back together most significant
+    # word first, as LiteX lays them out.
+    @phase('snapshot')
+    def snapshot(self):
+        addrs = []
+        for (name, addr) in self.csr_addrs.items():
+            addrs += [addr + i * 4 for i in range(self.register_sizes.get(name, 1))]
+        values = self.peek_many(addrs)
+        registers = {}
+        for (name, addr) in sorted(self.csr_addrs.items(), key=lambda r: r[1]):
+            size = self.register_sizes.get(name, 1)
+            value = 0
+            for i in range(size):
+                value = (value << 32) | values[addr + i * 4]
+            registers[name] = '0x{:0{}x}'.format(value, size * 8)
+        return registers
+
+    # Without a sink, returns the data as one preallocated bytearray. With a sink -- either a
+    # callable taking (offset, data) or an object with write() -- each packet is handed over as
+    # it arrives and nothing is accumulated; the packet buffer is reused, so a sink that wants to
+    # keep the data must copy it. Returns the number of bytes read in that case.
+    def burst_read(self, addr, length, sink=None):
+        maxlen = self.transfer_size
+
+        if sink is None:
+            ret = bytearray(length)
+            view = memoryview(ret)
+        packet_count = length // maxlen
+        if (length % maxlen) != 0:
             packet_count += 1
 
+        packet = array.array('B', bytes(min(length, maxlen)))
         for pkt_num in range(packet_count):
             cur_addr = addr + pkt_num * maxlen
             if pkt_num == packet_count - 1:
-                if len % maxlen != 0:
-                    bufsize = len % maxlen
+                if length % maxlen != 0:
+                    bufsize = length % maxlen
                 else:
                     bufsize = maxlen
             else:
                 bufsize = maxlen
 
-            data = array.array('B', _dummy_s * bufsize)
-            numread = self.dev.ctrl_transfer(bmRequestType=(0x80 | 0x43), bRequest=0,
-                wValue=(cur_addr & 0xffff), wIndex=((cur_addr >> 16) & 0xffff),
-                data_or_wLength=data, timeout=500)
+            if bufsize != len(packet):
+                packet = array.array('B', bytes(bufsize))
+            numread = self.transfer('burst_read', 0x80 | 0x43, cur_addr, packet)
 
             if numread != bufsize:
                 print("Burst read error: {} bytes requested, {} bytes read at 0x{:08x}".format(bufsize, numread, cur_addr))
                 exit(1)
 
-            ret = ret + data
+            offset = pkt_num * maxlen
+            if sink is None:
+                view[offset:offset + bufsize] = packet
+            elif callable(sink):
+                sink(offset, memoryview(packet))
+            else:
+                sink.write(packet)
 
-        return ret
+        if sink is None:
+            return ret
+        return length
 
-    def burst_write(self, addr, data):
+    # `in_place` writes each packet to its own address, for targets other than the SPINOR page buffer
+    def burst_write(self, addr, data, in_place=False):
         if len(data) == 0:
             return
 
@@ -132,7 +343,7 @@ class PrecursorUsb:
         # to anywhere in the SPINOR address range.
         writebuf_addr = 0x2098_0000 # the current start address of the kernel, for example
 
-        maxlen = 4096
+        maxlen = self.transfer_size
         packet_count = len(data) // maxlen
         if (len(data) % maxlen) != 0:
             packet_count += 1
@@ -147,19 +358,41 @@ class PrecursorUsb:
             else:
                 bufsize = maxlen
 
-            wdata = array.array('B', data[(pkt_num * maxlen):(pkt_num * maxlen) + bufsize])
-            numwritten = self.dev.ctrl_transfer(bmRequestType=(0x00 | 0x43), bRequest=0,
-                # note use of writebuf_addr instead of cur_addr -> see comment above about the quirk of write addressing
-                wValue=(writebuf_addr & 0xffff), wIndex=((writebuf_addr >> 16) & 0xffff),
-                data_or_wLength=wdata, timeout=500)
+            wdata = array.array('B')
+            wdata.frombytes(data[(pkt_num * maxlen):(pkt_num * maxlen) + bufsize])
+            # note use of writebuf_addr instead of cur_addr -> see comment above about the quirk of write addressing
+            numwritten = self.transfer('burst_write', 0x00 | 0x43, cur_addr if in_place else writebuf_addr, wdata)
 
             if numwritten != bufsize:
                 print("Burst write error: {} bytes requested, {} bytes written at 0x{:08x}".format(bufsize, numwritten, cur_addr))
                 exit(1)
 
+    @phase('wdt')
     def ping_wdt(self):
-        self.poke(self.register('wdt_watchdog'), 1, display=False)
-        self.poke(self.register('wdt_watchdog'), 1, display=False)
+        armed = self.wdt_due is not None
+        # the ping's own transfers mustn't set off another one
+        self.wdt_due = None
+        try:
+            self.poke(self.register('wdt_watchdog'), 1, display=False)
+            self.poke(self.register('wdt_watchdog'), 1, display=False)
+        finally:
+            if armed:
+                self.wdt_due = self.clock() + self.wdt_interval
+
+    # pings the watchdog if wdt_interval has passed since the last ping
+    def keepalive(self):
+        if self.wdt_due is not None and self.clock() >= self.wdt_due:
+            self.ping_wdt()
+
+    # sleeps for `seconds`, waking up to ping the watchdog if it falls due meanwhile
+    def doze(self, seconds):
+        end = self.clock() + seconds
+        while self.clock() < end:
+            step = end - self.clock()
+            if self.wdt_due is not None:
+                step = min(step, max(self.wdt_due - self.clock(), 0.001))
+            self.sleep(step)
+            self.keepalive()
 
     def spinor_command_value(self, exec=0, lock_reads=0, cmd_code=0, dummy_cycles=0, data_words=0, has_arg=0):
         return ((exec & 1) << 1 |
@@ -191,14 +424,13 @@ class PrecursorUsb:
         )
         return self.peek(self.register('spinor_cmd_rbk_data'), display=False)
 
+    # WREN and WRDI have no argument phase (has_arg=0), so spinor_cmd_arg is left alone
     def flash_wren(self):
-        self.poke(self.register('spinor_cmd_arg'), 0)
         self.poke(self.register('spinor_command'),
             self.spinor_command_value(exec=1, lock_reads=1, cmd_code=self.WREN)
         )
 
     def flash_wrdi(self):
-        self.poke(self.register('spinor_cmd_arg'), 0)
         self.poke(self.register('spinor_command'),
             self.spinor_command_value(exec=1, lock_reads=1, cmd_code=self.WRDI)
         )
@@ -215,16 +447,45 @@ class PrecursorUsb:
             self.spinor_command_value(exec=1, lock_reads=1, cmd_code=self.BE4B, has_arg=1)
         )
 
+    def flash_be32k4b(self, block_address):
+        self.poke(self.register('spinor_cmd_arg'), block_address)
+        self.poke(self.register('spinor_command'),
+            self.spinor_command_value(exec=1, lock_reads=1, cmd_code=self.BE32K4B, has_arg=1)
+        )
+
+    def flash_ce(self):
+        self.poke(self.register('spinor_command'),
+            self.spinor_command_value(exec=1, lock_reads=1, cmd_code=self.CE)
+        )
+
     def flash_pp4b(self, address, data_bytes):
         self.poke(self.register('spinor_cmd_arg'), address)
         self.poke(self.register('spinor_command'),
             self.spinor_command_value(exec=1, lock_reads=1, cmd_code=self.PP4B, has_arg=1, data_words=(data_bytes//2))
         )
 
-    def load_csrs(self, fname=None):
+    @phase('csr_load')
+    def load_csrs(self, fname=None, use_cache=True):
         LOC_CSRCSV = 0x20277000 # this address shouldn't change because it's how we figure out our version number
         # CSR extraction:
         # dd if=soc_csr.bin of=csr_data_0.9.6.bin skip=2524 count=32 bs=1024
+
+        # fast path: the SHA-512 trailer identifies the descriptor, so if we have parsed
+        # this exact one before only the 64-byte trailer has to come over the wire
+        if use_cache:
+            if fname == None:
+                trailer = bytes(self.burst_read(LOC_CSRCSV + 0x7FC0, 0x40))
+            else:
+                with open(fname, "rb") as f:
+                    f.seek(0x7FC0)
+                    trailer = f.read(0x40)
+            if self.load_csr_cache(trailer):
+                self.csrs_loaded()
+                print("Using SoC {} registers (cached)".format(self.gitrev))
+                return
+
+        import hashlib
+        import csv
         if fname == None:
             csr_data = self.burst_read(LOC_CSRCSV, 0x8000)
         else:
@@ -252,13 +513,231 @@ class PrecursorUsb:
             if len(row) > 1:
                 if 'csr_register' in row[0]:
                     self.registers[row[1]] = row[2]
+                    self.register_sizes[row[1]] = int(row[3])
                 if 'memory_region' in row[0]:
                     self.regions[row[1]] = [row[2], row[3]]
                 if 'git_rev' in row[0]:
                     self.gitrev = row[1]
+        self.csrs_loaded()
+        if use_cache:
+            self.save_csr_cache(digest)
         print("Using SoC {} registers".format(self.gitrev))
 
-    def erase_region(self, addr, length):
+    def csrs_loaded(self):
+        # resolve the hex strings once, rather than on every register() lookup
+        self.csr_addrs = {name: int(addr, 0) for (name, addr) in self.registers.items()}
+        self.shadow_addrs = set(self.csr_addrs[name] for name in self.SHADOWED if name in self.csr_addrs)
+        self.shadow_invalidate()
+        if 'wdt_watchdog' in self.csr_addrs:
+            self.wdt_due = self.clock() + self.wdt_interval
+
+    def csr_cache_path(self, digest):
+        return os.path.join(cache_dir(), 'csr', digest.hex() + '.json')
+
+    def load_csr_cache(self, digest):
+        if len(digest) != 0x40:
+            return False
+        try:
+            with open(self.csr_cache_path(digest), "r") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if cached.get('version') != CSR_CACHE_VERSION:
+            return False
+        self.registers = cached['registers']
+        self.regions = cached['regions']
+        self.register_sizes = cached['register_sizes']
+        self.gitrev = cached['gitrev']
+        return True
+
+    # entries are only ever written after the full descriptor passed its digest check
+    def save_csr_cache(self, digest):
+        path = self.csr_cache_path(digest)
+        cached = {
+            'version': CSR_CACHE_VERSION,
+            'gitrev': self.gitrev,
+            'registers': self.registers,
+            'register_sizes': self.register_sizes,
+            'regions': self.regions,
+        }
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # several devices may be loading the same descriptor at once
+            tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+            with open(tmp, "w") as f:
+                json.dump(cached, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            print("Couldn't write CSR cache {}: {}".format(path, e))
+
+    def tuning_path(self):
+        return os.path.join(cache_dir(), 'tune.json')
+
+    def tuning_key(self):
+        import platform
+        return '{}/{}'.format(platform.node(), self.gitrev)
+
+    # applies the transfer size --tune saved for this host and gitrev, if there is one
+    def load_tuning(self):
+        tuned = load_tunings(self.tuning_path()).get(self.tuning_key())
+        if tuned is None:
+            return None
+        self.transfer_size = tuned['transfer_size']
+        self.transfer_timeout = tuned['transfer_timeout']
+        for r in tuned['results']:
+            if r['size'] == self.transfer_size and r['ms_per_transfer'] is not None:
+                self.transfer_ms = r['ms_per_transfer']
+        return tuned
+
+    # Times burst_read of `length` bytes at `read_addr` (somewhere in flash, which reading
+    # doesn't disturb) for each of TUNE_SIZES, and burst_write where there is SRAM to write
+    # to: with the CPU halted, a window of SRAM is read once and written back unchanged.
+    # Every size has to return the same data as 4096-byte transfers do, and leave the SRAM as
+    # it found it; sizes that don't are rejected however fast they are. Picks the size with the
+    # best combined throughput, saves it with a timeout derived from the measured transfer
+    # times, and returns the saved entry.
+    @phase('tune')
+    def tune_transfers(self, read_addr, length=0x4_0000):
+        import platform
+        # the reference reads, and the SRAM restore if a size mangles it, use the stock size
+        self.transfer_size = 4096
+        ram = None
+        if 'sram' in self.regions:
+            ram = int(self.regions['sram'][0], 0)
+            length = min(length, int(self.regions['sram'][1], 0))
+            self.halt()
+            contents = bytes(self.burst_read(ram, length))
+        reference = bytes(self.burst_read(read_addr, length))
+        results = []
+        # generous while probing sizes the host or gateware may not handle
+        self.transfer_timeout = 2000
+        try:
+            for size in self.TUNE_SIZES:
+                self.transfer_size = size
+                packets = (length + size - 1) // size
+                result = {'size': size, 'read': None, 'write': None, 'ms_per_transfer': None}
+                try:
+                    start = self.clock()
+                    data = self.burst_read(read_addr, length)
+                    read_secs = self.clock() - start
+                    if bytes(data) != reference:
+                        print("Transfer size {} read back the wrong data".format(size))
+                        results.append(result)
+                        continue
+                    result['read'] = length / read_secs
+                    secs = read_secs
+                    if ram is not None:
+                        start = self.clock()
+                        self.burst_write(ram, contents, in_place=True)
+                        write_secs = self.clock() - start
+                        self.transfer_size = 4096
+                        if bytes(self.burst_read(ram, length)) != contents:
+                            print("Transfer size {} wrote the wrong data".format(size))
+                            self.burst_write(ram, contents, in_place=True)
+                            results.append(result)
+                            continue
+                        result['write'] = length / write_secs
+                        secs += write_secs
+                        packets *= 2
+                    result['ms_per_transfer'] = secs * 1000 / packets
+                except (usb.core.USBError, SystemExit) as e:
+                    # a size the host or gateware can't take shows up as an error or a short transfer
+                    print("Transfer size {} failed: {}".format(size, e))
+                    results.append(result)
+                    break
+                results.append(result)
+        finally:
+            if ram is not None:
+                self.unhalt()
+
+        worked = [r for r in results if r['ms_per_transfer'] is not None]
+        if len(worked) == 0:
+            print("No transfer size worked, keeping the defaults")
+            self.transfer_size = 4096
+            self.transfer_timeout = 500
+            return None
+        best = max(worked, key=lambda r: r['size'] / r['ms_per_transfer'])
+        self.transfer_size = best['size']
+        self.transfer_ms = best['ms_per_transfer']
+        # far beyond a normal transfer, but never shorter than the old fixed timeout
+        self.transfer_timeout = max(500, int(best['ms_per_transfer'] * 20))
+        tuned = {
+            'host': platform.node(),
+            'gitrev': self.gitrev,
+            'transfer_size': self.transfer_size,
+            'transfer_timeout': self.transfer_timeout,
+            'results': results,
+        }
+        save_tuning(self.tuning_path(), self.tuning_key(), tuned)
+        return tuned
+
+    # waits for WIP to clear after `op`: sleeps through most of the typical busy time first,
+    # then polls with an exponential backoff so a long erase costs a handful of transfers
+    @phase('poll')
+    def flash_wait_idle(self, op):
+        (typical, maximum) = self.TIMING[op]
+        if self.poll_timeout is not None:
+            timeout = self.poll_timeout
+        else:
+            timeout = maximum * 2
+        start = self.clock()
+        if typical > 0.002:
+            self.doze(typical * 0.75)
+        interval = max(typical / 8, 0.001)
+        polls = 0
+        while True:
+            polls += 1
+            if (self.flash_rdsr(1) & 0x01) == 0:
+                break
+            if self.clock() - start > timeout:
+                print("Timeout waiting for flash {} to finish after {:.3f}s, aborting!".format(op, timeout))
+                exit(1)
+            self.doze(interval)
+            interval = min(interval * 2, max(typical / 4, 0.001), 0.05)
+        self.record_polls(op, polls, self.clock() - start)
+
+    # sets WEL, which also implicitly waits for any page program still in flight to finish
+    @phase('poll')
+    def flash_wren_wait(self):
+        if self.poll_timeout is not None:
+            timeout = self.poll_timeout
+        else:
+            # the page program it may be waiting on, plus the round trips of the polls themselves
+            timeout = self.TIMING['pp'][1] * 2 + 0.1
+        start = self.clock()
+        polls = 0
+        while True:
+            polls += 1
+            self.flash_wren()
+            status = self.flash_rdsr(1)
+            if status & 0x03 == 0x02:
+                break
+            if self.clock() - start > timeout:
+                print("Timeout waiting for flash write enable after {:.3f}s, aborting!".format(timeout))
+                exit(1)
+        self.record_polls('wren', polls, self.clock() - start)
+
+    def record_polls(self, op, polls, waited):
+        # [operations, total polls, most polls for one operation, total seconds waited]
+        stats = self.poll_stats.setdefault(op, [0, 0, 0, 0.0])
+        stats[0] += 1
+        stats[1] += polls
+        stats[2] = max(stats[2], polls)
+        stats[3] += waited
+
+    def report(self):
+        report = self.stats.report()
+        report['gitrev'] = self.gitrev
+        report['elided_writes'] = self.elided_writes
+        report['status_polls'] = {op: {'ops': ops, 'polls': polls, 'max_polls': most, 'seconds': waited}
+            for (op, (ops, polls, most, waited)) in self.poll_stats.items()}
+        return report
+
+    def print_poll_stats(self):
+        for (op, (ops, polls, most, waited)) in sorted(self.poll_stats.items()):
+            print("  {:5}: {} ops, {} status polls (max {}), {:.3f}s waiting".format(op, ops, polls, most, waited))
+
+    def flash_check_id(self):
         # ID code check
         code = self.flash_rdid(1)
         print("ID code bytes 1-2: 0x{:08x}".format(code))
@@ -271,131 +750,473 @@ class PrecursorUsb:
             print("ID code mismatch")
             exit(1)
 
-        # block erase
-        progress = ProgressBar(min_value=0, max_value=length, prefix='Erasing ').start()
-        erased = 0
-        while erased < length:
-            self.ping_wdt()
-            if (length - erased >= 65536) and ((addr & 0xFFFF) == 0):
-                blocksize = 65536
-            else:
-                blocksize = 4096
-
-            while True:
-                self.flash_wren()
-                status = self.flash_rdsr(1)
-                if status & 0x02 != 0:
-                    break
+    # The erase status is read back after every block, since the next erase clears E_FAIL.
+    # `check` also makes sure WEL is clear afterwards; a run of erases only needs that once,
+    # after the last one.
+    @phase('erase')
+    def flash_erase_block(self, address, blocksize, check=True):
+        self.flash_wren_wait()
+
+        if blocksize == 0x1000:
+            self.flash_se4b(address)
+            self.flash_wait_idle('se')
+        elif blocksize == 0x8000:
+            self.flash_be32k4b(address)
+            self.flash_wait_idle('be32')
+        else:
+            self.flash_be4b(address)
+            self.flash_wait_idle('be')
 
-            if blocksize == 4096:
-                self.flash_se4b(addr + erased)
-            else:
-                self.flash_be4b(addr + erased)
-            erased += blocksize
+        result = self.flash_rdscur()
+        if result & 0x60 != 0:
+            print("E_FAIL/P_FAIL set on erase at 0x{:08x}, programming may fail, but trying anyways...".format(address))
 
-            while (self.flash_rdsr(1) & 0x01) != 0:
+        if check == False:
+            return
+        if self.flash_rdsr(1) & 0x02 != 0:
+            self.flash_wrdi()
+            while (self.flash_rdsr(1) & 0x02) != 0:
                 pass
 
-            result = self.flash_rdscur()
-            if result & 0x60 != 0:
-                print("E_FAIL/P_FAIL set on erase, programming may fail, but trying anyways...")
-
-            if self.flash_rdsr(1) & 0x02 != 0:
-                self.flash_wrdi()
-                while (self.flash_rdsr(1) & 0x02) != 0:
-                    pass
-            if erased < length:
-                progress.update(erased)
-        progress.finish()
-        print("Erase finished")
-
-    # addr is relative to the base of FLASH (not absolute)
-    def flash_program(self, addr, data, verify=True):
+    # Erases the whole device with one chip erase, so it takes about the datasheet time instead
+    # of thousands of block erases and their USB handshakes. This takes the SoC gateware and its
+    # CSR descriptor with it: the caller must have what it's going to put back there in hand.
+    # Returns False, having changed nothing, if the part didn't take the command (e.g. because
+    # of block protection), in which case the caller should fall back to block erases.
+    @phase('erase')
+    def flash_erase_chip(self):
         flash_region = int(self.regions['spiflash'][0], 0)
         flash_len = int(self.regions['spiflash'][1], 0)
+        (typical, maximum) = self.TIMING['ce']
+        if self.poll_timeout is not None:
+            timeout = self.poll_timeout
+        else:
+            timeout = maximum * 2
+
+        self.flash_wren_wait()
+        self.flash_ce()
+        start = self.clock()
+        if (self.flash_rdsr(1) & 0x01) == 0:
+            # a protected part ignores CE without ever going busy
+            print("Chip erase didn't start")
+            self.flash_wrdi()
+            return False
+        progress = self.progress_bar(int(typical), 'Erasing ')
+        polls = 0
+        # this takes minutes, so only poll about once a second
+        while True:
+            self.doze(1.0)
+            polls += 1
+            if (self.flash_rdsr(1) & 0x01) == 0:
+                break
+            elapsed = self.clock() - start
+            if elapsed > timeout:
+                print("Timeout waiting for chip erase to finish after {:.0f}s, aborting!".format(timeout))
+                exit(1)
+            progress.update(min(int(elapsed), int(typical)))
+        progress.finish()
+        self.record_polls('ce', polls, self.clock() - start)
 
-        if (addr + len(data) > flash_len):
-            print("Write data out of bounds! Aborting.")
-            exit(1)
+        if self.flash_rdscur() & 0x60 != 0:
+            print("E_FAIL set on chip erase")
+            return False
+        if self.flash_rdsr(1) & 0x02 != 0:
+            self.flash_wrdi()
+            while (self.flash_rdsr(1) & 0x02) != 0:
+                pass
+        # spot-check that it really is blank
+        self.flash_rdsr(0)
+        for offset in (flash_len // 2, flash_len - 0x1000):
+            if not is_erased(self.burst_read(flash_region + offset, 0x1000)):
+                print("Chip erase left data at 0x{:08x}".format(offset))
+                return False
+        return True
+
+    # Covers [addr, addr+length), widened to 4 KiB sector boundaries, with the fewest erase
+    # operations: small sectors up to the first larger boundary, the largest blocks that fit in
+    # the middle, and small sectors again for the tail. Returns a list of (address, size).
+    def erase_plan(self, addr, length):
+        if length == 0:
+            return []
+        start = addr & ~0xFFF
+        end = (addr + length + 0xFFF) & ~0xFFF
+        plan = []
+        while start < end:
+            for size in self.ERASE_SIZES:
+                if (start & (size - 1)) == 0 and start + size <= end:
+                    break
+            plan.append((start, size))
+            start += size
+        return plan
 
-        # ID code check
-        code = self.flash_rdid(1)
-        print("ID code bytes 1-2: 0x{:08x}".format(code))
-        if code != 0x8080c2c2:
-            print("ID code mismatch")
-            exit(1)
-        code = self.flash_rdid(2)
-        print("ID code bytes 2-3: 0x{:08x}".format(code))
-        if code != 0x3b3b8080:
-            print("ID code mismatch")
+    # erases [addr, addr+length), advancing `progress` from `done` as it goes. A successful
+    # erase clears WEL by itself, so the WEL handshake is left to the last block.
+    def flash_erase_range(self, addr, length, progress=None, done=0):
+        erased = 0
+        plan = self.erase_plan(addr, length)
+        for (i, (block, blocksize)) in enumerate(plan):
+            self.flash_erase_block(block, blocksize, check=(i == len(plan) - 1))
+            erased += blocksize
+            if progress is not None and erased < length:
+                progress.update(done + erased)
+        return erased
+
+    def erase_region(self, addr, length, check_id=True):
+        if addr < 0 or length < 0 or addr + length > int(self.regions['spiflash'][1], 0):
+            print("Erase range out of bounds! Aborting.")
             exit(1)
+        if check_id:
+            self.flash_check_id()
 
         # block erase
-        progress = ProgressBar(min_value=0, max_value=len(data), prefix='Erasing ').start()
-        erased = 0
-        while erased < len(data):
-            self.ping_wdt()
-            if (len(data) - erased >= 65536) and ((addr & 0xFFFF) == 0):
-                blocksize = 65536
-            else:
-                blocksize = 4096
-
-            while True:
-                self.flash_wren()
-                status = self.flash_rdsr(1)
-                if status & 0x02 != 0:
-                    break
+        progress = self.progress_bar(length, 'Erasing ')
+        self.flash_erase_range(addr, length, progress)
+        progress.finish()
+        print("Erase finished")
 
-            if blocksize == 4096:
-                self.flash_se4b(addr + erased)
-            else:
-                self.flash_be4b(addr + erased)
-            erased += blocksize
+    # compares the current flash contents against `data` one 4 KiB sector at a time, and
+    # returns the set of sector addresses (relative to the base of FLASH) that need rewriting,
+    # plus the subset of those that are already blank and so can be programmed without an erase
+    @phase('delta_read')
+    def flash_diff_sectors(self, addr, data):
+        import hashlib
+        flash_region = int(self.regions['spiflash'][0], 0)
+        start = addr & ~0xFFF
+        end = (addr + len(data) + 0xFFF) & ~0xFFF
 
-            while (self.flash_rdsr(1) & 0x01) != 0:
-                pass
+        # dummy read to clear the "read lock" bit left by an earlier erase, so the array can be read
+        self.flash_rdsr(0)
+        dirty = set()
+        blank = set()
+        progress = self.progress_bar(end - start, 'Reading ')
+        for chunk in range(start, end, 0x1_0000):
+            chunk_end = min(chunk + 0x1_0000, end)
+            current = self.burst_read(flash_region + chunk, chunk_end - chunk)
+            for sector in range(chunk, chunk_end, 4096):
+                # only the part of the sector covered by the image counts
+                lo = max(sector, addr)
+                hi = min(sector + 4096, addr + len(data))
+                old = hashlib.sha256(current[lo - chunk:hi - chunk]).digest()
+                new = hashlib.sha256(data[lo - addr:hi - addr]).digest()
+                if old != new:
+                    dirty.add(sector)
+                    if is_erased(current[sector - chunk:sector - chunk + 4096]):
+                        blank.add(sector)
+            progress.update(chunk_end - start)
+        progress.finish()
+        print("Delta: {} of {} sectors changed, {} of them already blank".format(len(dirty), (end - start) // 4096, len(blank)))
+        return dirty, blank
 
-            result = self.flash_rdscur()
-            if result & 0x60 != 0:
-                print("E_FAIL/P_FAIL set on erase, programming may fail, but trying anyways...")
+    # addr is relative to the base of FLASH (not absolute)
+    # `image` may be bytes, a path, an open file or an mmap; see open_image()
+    # with `delta` set, the current contents are read back first and only the 4 KiB
+    # sectors that differ from the image are erased and reprogrammed
+    # with `erase` cleared the target is assumed to be blank already
+    # `check_id` can be turned off when the caller has already checked the flash ID in this halt window
+    def flash_program(self, addr, image, verify=True, delta=False, erase=True, check_id=True):
+        with open_image(image) as data:
+            self.flash_program_view(addr, data, verify=verify, delta=delta, erase=erase, check_id=check_id)
+
+    def device_id(self):
+        serial = device_serial(self.dev)
+        if serial:
+            return ''.join(c if c.isalnum() else '_' for c in serial)
+        return device_name(self.dev)
+
+    def journal_path(self, addr, digest):
+        return os.path.join(cache_dir(), 'journal', '{}-{:08x}-{}.json'.format(self.device_id(), addr, digest[:16]))
+
+    def journal_update(self, path, journal, block_start, state):
+        index = (block_start >> 16) - (journal['addr'] >> 16)
+        del journal['blocks'][index:]
+        journal['blocks'].append(state)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', "w") as f:
+                json.dump(journal, f)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            print("Couldn't update progress journal {}: {}".format(path, e))
+
+    def journal_remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    # Works out where an interrupted flash_program left off: the blocks the journal records as
+    # complete are trusted, except the last one, which is read back and redone if it doesn't
+    # match. Returns the offset into the image to continue from.
+    def journal_resume(self, path, journal, data, verify):
+        try:
+            with open(path, "r") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            print("No progress journal for this image, starting from the beginning")
+            return 0
+        if saved.get('length') != journal['length'] or saved.get('addr') != journal['addr']:
+            print("Progress journal doesn't match this image, starting from the beginning")
+            return 0
+
+        complete = ['verified'] if verify else ['programmed', 'verified']
+        done = 0
+        for state in saved['blocks']:
+            if state not in complete:
+                break
+            done += 1
+        addr = journal['addr']
+        def block_offset(index):
+            if index == 0:
+                return 0
+            return min(((addr & ~0xFFFF) + (index << 16)) - addr, journal['length'])
+
+        if done > 0:
+            lo = block_offset(done - 1)
+            hi = block_offset(done)
+            self.flash_rdsr(0) # clear the read lock
+            (count, _) = self.flash_verify(addr + lo, data[lo:hi], 0)
+            if count != 0:
+                print("Last completed block at 0x{:08x} doesn't read back correctly, redoing it".format(addr + lo))
+                done -= 1
+        journal['blocks'] = saved['blocks'][:done]
+        offset = block_offset(done)
+        print("Resuming at 0x{:08x}: {} blocks already done".format(addr + offset, done))
+        return offset
+
+    # reads back len(expected) bytes at `addr` (relative to FLASH) and compares them; returns the
+    # number of mismatched bytes and (offset, expected, actual) for at most the first `limit`
+    @phase('verify')
+    def flash_verify(self, addr, expected, limit):
+        flash_region = int(self.regions['spiflash'][0], 0)
+        rbk_data = self.burst_read(flash_region + addr, len(expected))
+        (count, offsets) = compare_buffers(expected, rbk_data, limit)
+        return (count, [(offset, expected[offset], rbk_data[offset]) for offset in offsets])
+
+    # Reads back a stratified sample of the 256-byte pages in `expected`: the first and last page
+    # always, plus one random page from each of a number of equal strata in between, chosen so
+    # that about self.verify_sample of the pages are checked. Adjacent picks are read together.
+    # Returns the number of mismatched bytes found and the number of bytes checked.
+    def flash_verify_sampled(self, addr, expected, rng):
+        pages = (len(expected) + 255) // 256
+        picks = {0, pages - 1}
+        strata = min(max(round(pages * self.verify_sample) - 2, 0), max(pages - 2, 0))
+        for i in range(strata):
+            lo = 1 + (pages - 2) * i // strata
+            hi = 1 + (pages - 2) * (i + 1) // strata
+            if hi > lo:
+                picks.add(rng.randrange(lo, hi))
+
+        errors = 0
+        checked = 0
+        runs = []
+        for page in sorted(picks):
+            if len(runs) > 0 and runs[-1][1] == page:
+                runs[-1][1] = page + 1
+            else:
+                runs.append([page, page + 1])
+        for (first, last) in runs:
+            lo = first * 256
+            hi = min(last * 256, len(expected))
+            (count, _) = self.flash_verify(addr + lo, expected[lo:hi], 0)
+            errors += count
+            checked += hi - lo
+        return (errors, checked)
+
+    # Streams [addr, addr+length) of FLASH (offsets from its base) to the file object `out`, 64 KiB
+    # at a time with the watchdog pinged in between. With `sparse`, erased 4 KiB sectors are seeked
+    # over instead of written, leaving holes in the file; note that holes read back as zeros, not
+    # 0xFF. Returns the erased [offset, length] runs (relative to addr) and the SHA-256 of the
+    # flash contents.
+    @phase('dump')
+    def flash_dump(self, addr, length, out, sparse=False):
+        import hashlib
+        flash_region = int(self.regions['spiflash'][0], 0)
+        flash_len = int(self.regions['spiflash'][1], 0)
+        if addr < 0 or length < 0 or addr + length > flash_len:
+            print("Dump range out of bounds! Aborting.")
+            exit(1)
 
-            if self.flash_rdsr(1) & 0x02 != 0:
-                self.flash_wrdi()
-                while (self.flash_rdsr(1) & 0x02) != 0:
-                    pass
-            if erased < len(data):
-                progress.update(erased)
+        # dummy read to clear the "read lock" bit so the array can be read
+        self.flash_rdsr(0)
+        erased = []
+        digest = hashlib.sha256()
+        done = 0
+        progress = self.progress_bar(length, 'Dumping ')
+        while done < length:
+            chunk = self.burst_read(flash_region + addr + done, min(0x1_0000, length - done))
+            digest.update(chunk)
+            view = memoryview(chunk)
+            for offset in range(0, len(chunk), 0x1000):
+                sector = view[offset:offset + 0x1000]
+                if not is_erased(sector):
+                    out.write(sector)
+                    continue
+                if len(erased) > 0 and erased[-1][0] + erased[-1][1] == done + offset:
+                    erased[-1][1] += len(sector)
+                else:
+                    erased.append([done + offset, len(sector)])
+                if sparse:
+                    out.seek(len(sector), os.SEEK_CUR)
+                else:
+                    out.write(sector)
+            done += len(chunk)
+            if done < length:
+                progress.update(done)
         progress.finish()
-        print("Erase finished")
+        if sparse:
+            # a hole at the very end only counts once the file is extended over it
+            out.truncate()
+        return (erased, digest.hexdigest())
+
+    # The image is handled one 64 KiB erase block at a time: erase, program, then (optionally)
+    # read back and compare that block before moving on, so verification never turns into one
+    # long readback at the end that the watchdog can't sit through.
+    @phase('program')
+    def flash_program_view(self, addr, data, verify=True, delta=False, erase=True, check_id=True):
+        import hashlib
+        import random
+        flash_len = int(self.regions['spiflash'][1], 0)
 
-        # program
-        # pad out to the nearest word length
-        if len(data) % 4 != 0:
-            data += bytearray([0xff] * (4 - (len(data) % 4)))
+        if (addr + len(data) > flash_len):
+            print("Write data out of bounds! Aborting.")
+            exit(1)
+
+        if check_id:
+            self.flash_check_id()
+
+        started = self.clock()
+        # pad out to the nearest word length; only the final page ever needs it
+        length = len(data)
+        padded_len = (length + 3) & ~3
+
+        # progress journal: one state per 64 KiB block, kept on the host so an interrupted
+        # update can be picked up again with self.resume
+        journal = {
+            'addr': addr,
+            'length': length,
+            'sha256': hashlib.sha256(data).hexdigest(),
+            'blocks': [],
+        }
+        journal_path = self.journal_path(addr, journal['sha256'])
         written = 0
-        progress = ProgressBar(min_value=0, max_value=len(data), prefix='Writing ').start()
-        while written < len(data):
-            self.ping_wdt()
-            if len(data) - written > 256:
-                chunklen = 256
+        if self.resume:
+            written = self.journal_resume(journal_path, journal, data, verify)
+        written_at_start = written
+
+        if delta:
+            (dirty, blank) = self.flash_diff_sectors(addr + written, data[written:])
+            to_erase = dirty - blank
+
+        skipped_pages = 0
+        skipped_bytes = 0
+        errs = 0
+        err_thresh = 64
+        rng = None
+        if verify:
+            if self.verify_sample is not None:
+                seed = self.verify_seed
+                if seed is None:
+                    seed = random.randrange(1 << 32)
+                rng = random.Random(seed)
+                sampled_bytes = 0
+                escalated = 0
+                print("Programming with sampled readback of {:.1%} of each block (seed {})...".format(self.verify_sample, seed))
             else:
-                chunklen = len(data) - written
-
-            while True:
-                self.flash_wren()
-                status = self.flash_rdsr(1)
-                if status & 0x02 != 0:
+                print("Programming with readback verification after each block...")
+        progress = self.progress_bar(padded_len, 'Writing ')
+        while written < padded_len:
+            block_start = addr + written
+            block_end = min((block_start + 0x1_0000) & ~0xFFFF, addr + padded_len)
+
+            # erase
+            if delta:
+                # coalesce the changed sectors into contiguous runs for erasing
+                runs = []
+                for sector in range(block_start & ~0xFFF, block_end, 4096):
+                    if sector not in to_erase:
+                        continue
+                    if len(runs) > 0 and runs[-1][0] + runs[-1][1] == sector:
+                        runs[-1][1] += 4096
+                    else:
+                        runs.append([sector, 4096])
+            elif erase:
+                runs = [[block_start, block_end - block_start]]
+            else:
+                runs = []
+            for (run_addr, run_len) in runs:
+                self.flash_erase_range(run_addr, run_len)
+            self.journal_update(journal_path, journal, block_start, 'erased')
+
+            # program
+            programmed = False
+            while addr + written < block_end:
+                chunklen = min(256, block_end - (addr + written))
+                if written + chunklen <= length:
+                    chunk = data[written:(written+chunklen)]
+                else:
+                    chunk = bytes(data[written:length]) + bytes([0xff] * (padded_len - length))
+
+                if delta:
+                    page_addr = addr + written
+                    if (page_addr & ~0xFFF) not in dirty and ((page_addr + chunklen - 1) & ~0xFFF) not in dirty:
+                        written += chunklen
+                        continue
+
+                # programming 0xFF leaves erased NOR cells untouched, so blank pages need no transfers at all
+                if is_erased(chunk):
+                    skipped_pages += 1
+                    skipped_bytes += chunklen
+                    written += chunklen
+                    continue
+
+                self.flash_wren_wait()
+
+                self.burst_write(self.register('spinor_wdata'), chunk)
+                self.flash_pp4b(addr + written, chunklen)
+                programmed = True
+
+                written += chunklen
+            if programmed:
+                self.flash_wait_idle('pp')
+            self.journal_update(journal_path, journal, block_start, 'programmed')
+
+            # verify; with delta, a block without dirty sectors has just been read back and compared
+            if verify and delta and not any(sector in dirty for sector in range(block_start & ~0xFFF, block_end, 4096)):
+                self.journal_update(journal_path, journal, block_start, 'verified')
+            elif verify:
+                # dummy read to clear the "read lock" bit so the array can be read back
+                self.flash_rdsr(0)
+                check_len = min(block_end, addr + length) - block_start
+                expected = data[block_start - addr:block_start - addr + check_len]
+                count = 0
+                checked = 0
+                if rng is not None:
+                    (count, checked) = self.flash_verify_sampled(block_start, expected, rng)
+                    if count > 0:
+                        print("Sampled readback found errors in the block at 0x{:08x}, checking all of it".format(block_start))
+                        escalated += 1
+                if rng is None or count > 0:
+                    (count, errors) = self.flash_verify(block_start, expected, err_thresh - errs)
+                    for (offset, expect, actual) in errors:
+                        print("Error at 0x{:x}: {:x}->{:x}".format(block_start - addr + offset, expect, actual))
+                    checked = check_len
+                if rng is not None:
+                    sampled_bytes += checked
+                errs += count
+                if errs >= err_thresh:
+                    print("Too many errors, stopping...")
                     break
+                if count == 0:
+                    self.journal_update(journal_path, journal, block_start, 'verified')
 
-            self.burst_write(self.register('spinor_wdata'), data[written:(written+chunklen)])
-            self.flash_pp4b(addr + written, chunklen)
-
-            written += chunklen
-            if written < len(data):
+            if written < padded_len:
                 progress.update(written)
         progress.finish()
         print("Write finished")
+        if skipped_pages > 0:
+            print("Skipped {} blank pages ({} bytes)".format(skipped_pages, skipped_bytes))
 
+        self.flash_wait_idle('pp')
         if self.flash_rdsr(1) & 0x02 != 0:
             self.flash_wrdi()
             while (self.flash_rdsr(1) & 0x02) != 0:
@@ -404,24 +1225,29 @@ class PrecursorUsb:
         # dummy reads to clear the "read lock" bit
         self.flash_rdsr(0)
 
-        # verify
-        self.ping_wdt()
+        if rng is not None:
+            print("Sampled verification covered {} of {} bytes ({:.1%}), {} blocks fully re-checked".format(
+                sampled_bytes, length, sampled_bytes / max(length, 1), escalated))
+        elapsed = self.clock() - started
+        self.stats.images.append({
+            'addr': addr,
+            'length': length,
+            'sha256': journal['sha256'],
+            'seconds': elapsed,
+            'bytes_per_second': (length - written_at_start) / elapsed if elapsed > 0 else None,
+            'skipped_pages': skipped_pages,
+            'verify': 'sampled' if rng is not None else bool(verify),
+            'byte_errors': errs,
+        })
+        if errs == 0:
+            self.journal_remove(journal_path)
         if verify:
-            print("Performing readback for verification...")
-            self.ping_wdt()
-            rbk_data = self.burst_read(addr + flash_region, len(data))
-            if rbk_data != data:
-                errs = 0
-                err_thresh = 64
-                for i in range(0, len(rbk_data)):
-                    if rbk_data[i] != data[i]:
-                        if errs < err_thresh:
-                            print("Error at 0x{:x}: {:x}->{:x}".format(i, data[i], rbk_data[i]))
-                        errs += 1
-                    if errs == err_thresh:
-                        print("Too many errors, stopping print...")
+            if errs > 0:
                 print("Errors were found in verification, programming failed")
-                print("Total byte errors: {}".format(errs))
+                if errs >= err_thresh:
+                    print("Total byte errors: at least {}".format(errs))
+                else:
+                    print("Total byte errors: {}".format(errs))
                 exit(1)
             else:
                 print("Verification passed.")
@@ -430,9 +1256,842 @@ class PrecursorUsb:
 
         self.ping_wdt()
 
+ERASED = memoryview(b'\xff' * 0x1_0000)
+
+# blank NOR flash reads back as all 1s; checked with C-level compares against a
+# preallocated blank buffer rather than a per-byte loop
+def is_erased(data):
+    with memoryview(data) as view:
+        for offset in range(0, len(view), len(ERASED)):
+            piece = view[offset:offset + len(ERASED)]
+            if piece != ERASED[:len(piece)]:
+                return False
+    return True
+
+# maps every nonzero byte to 1, so the positions of differences can be found with find()
+NONZERO = bytes([0] + [1] * 255)
+
+# counts the bytes that differ between two equal-length buffers and returns that count along
+# with the offsets of (at most) the first `limit` differences; no Python-level per-byte loop
+def compare_buffers(expected, actual, limit):
+    if expected == actual:
+        return (0, [])
+    diff = (int.from_bytes(expected, 'little') ^ int.from_bytes(actual, 'little')).to_bytes(len(expected), 'little')
+    count = len(diff) - diff.count(0)
+    marks = diff.translate(NONZERO)
+    offsets = []
+    pos = marks.find(1)
+    while pos != -1 and len(offsets) < limit:
+        offsets.append(pos)
+        pos = marks.find(1, pos + 1)
+    return (count, offsets)
+
+def download_image(base_url, name):
+    import urllib.request
+    with urllib.request.urlopen(base_url + name) as f:
+        image = f.read()
+        expected = f.headers.get('Content-Length')
+        if expected != None and int(expected) != len(image):
+            raise IOError("short download of {}: {} of {} bytes".format(name, len(image), expected))
+    return image
+
+# one lock per mirrored file, so that devices updated in parallel download each image once
+MIRROR_LOCKS = {}
+MIRROR_LOCKS_GUARD = threading.Lock()
+
+# fetches one factory image, preferring a copy in `mirror` and saving downloads there;
+# returns the path of the mirrored file, or the image itself when there's no mirror
+def fetch_image(base_url, name, mirror=None):
+    if mirror == None:
+        return download_image(base_url, name)
+    path = os.path.join(mirror, name)
+    with MIRROR_LOCKS_GUARD:
+        lock = MIRROR_LOCKS.setdefault(os.path.abspath(path), threading.Lock())
+    with lock:
+        if os.path.exists(path):
+            return path
+        image = download_image(base_url, name)
+        os.makedirs(mirror, exist_ok=True)
+        # other processes may be filling the same mirror
+        tmp = '{}.{}.{}.part'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(image)
+        os.replace(tmp, path)
+    return path
+
+# parses a `sha256sum`-style file into {name: hex digest}
+def read_sums(fname):
+    sums = {}
+    with open(fname, "r") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 2:
+                sums[fields[1].lstrip('*')] = fields[0].lower()
+    return sums
+
+# Erases the whole flash and burns the factory images. The images are fetched in background
+# threads while the erase runs, and each one is programmed as soon as it has arrived and the
+# 64 KiB blocks under it are erased -- out of order, ahead of the sweep, if need be.
+def factory_new(pc_usb, locs, args):
+    import concurrent.futures
+    import hashlib
+    flash_len = 0x800_0000
+    base_url = args.factory_url
+    if not base_url.endswith('/'):
+        base_url += '/'
+    sums = {}
+    if args.factory_sums != None:
+        sums = read_sums(args.factory_sums)
+
+    images = sorted((sections[0], sections[1]) for sections in locs.values() if sections[1] != 'pass')
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(images))
+    fetches = {}
+    for (loc, name) in images:
+        print('retrieving {}'.format(base_url + name))
+        fetches[name] = pool.submit(fetch_image, base_url, name, args.mirror)
+
+    pc_usb.flash_check_id()
+    erased = set() # 64 KiB block numbers
+    def erase_blocks(blocks):
+        for block in blocks:
+            if block not in erased:
+                pc_usb.flash_erase_block(block << 16, 65536)
+                erased.add(block)
+
+    checked = {}
+    def fetch(name):
+        if name not in checked:
+            # the CPU is halted, so keep the watchdog fed while the download finishes
+            while not fetches[name].done():
+                pc_usb.keepalive()
+                concurrent.futures.wait([fetches[name]], timeout=pc_usb.wdt_interval)
+            try:
+                image = fetches[name].result()
+            except Exception as e:
+                print("Couldn't retrieve {}: {}".format(name, e))
+                exit(1)
+            with open_image(image) as data:
+                digest = hashlib.sha256(data).hexdigest()
+            if name in sums and sums[name] != digest:
+                print("SHA-256 mismatch for {}: expected {}, got {}".format(name, sums[name], digest))
+                exit(1)
+            print('{} sha256 {}'.format(name, digest))
+            checked[name] = image
+        return checked[name]
+
+    def burn(loc, name):
+        with open_image(fetch(name)) as data:
+            erase_blocks(range(loc >> 16, (loc + len(data) + 0xFFFF) >> 16))
+            print('burning at {:x}'.format(loc))
+            pc_usb.flash_program_view(loc, data, verify=False, erase=False, check_id=False)
+
+    # A chip erase wipes the SoC gateware and the CSR descriptor stored with it, so only start
+    # one once the SoC image is downloaded and checked, and put it back before anything else.
+    # The other images keep downloading while the erase runs.
+    soc = [(loc, name) for (loc, name) in images if loc == locs['LOC_SOC'][0]]
+    for (loc, name) in soc:
+        fetch(name)
+    print("Erasing the whole chip")
+    if pc_usb.flash_erase_chip():
+        print("Erase finished")
+        erased.update(range(flash_len >> 16))
+        for (loc, name) in soc + [image for image in images if image not in soc]:
+            burn(loc, name)
+        pool.shutdown()
+        return
+    print("Falling back to erasing block by block")
+
+    pending = list(images)
+    sweep = 0
+    progress = pc_usb.progress_bar(flash_len, 'Erasing ')
+    while sweep < flash_len >> 16:
+        ready = [(loc, name) for (loc, name) in pending if fetches[name].done()]
+        for (loc, name) in ready:
+            progress.finish()
+            burn(loc, name)
+            pending.remove((loc, name))
+            progress = pc_usb.progress_bar(flash_len, 'Erasing ')
+        erase_blocks([sweep])
+        sweep += 1
+        progress.update(sweep << 16)
+    progress.finish()
+    print("Erase finished")
+    for (loc, name) in pending:
+        burn(loc, name)
+    pool.shutdown()
+
+def load_tunings(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_tuning(path, key, tuned):
+    tunings = load_tunings(path)
+    tunings[key] = tuned
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp, "w") as f:
+            json.dump(tunings, f, indent=2)
+        os.replace(tmp, path)
+    except OSError as e:
+        print("Couldn't save tuning results to {}: {}".format(path, e))
+
+def print_tuning(tuned):
+    print("{} ({}): {} byte transfers, {} ms timeout".format(tuned['host'], tuned['gitrev'], tuned['transfer_size'], tuned['transfer_timeout']))
+    print("  {:>6} {:>12} {:>12} {:>10}".format('size', 'read KiB/s', 'write KiB/s', 'ms/xfer'))
+    for r in tuned['results']:
+        if r['ms_per_transfer'] is None:
+            print("  {:>6} {:>12}".format(r['size'], 'failed'))
+            continue
+        print("  {:>6} {:>12.1f} {:>12} {:>10.2f}{}".format(r['size'], r['read'] / 1024,
+            '-' if r['write'] is None else '{:.1f}'.format(r['write'] / 1024), r['ms_per_transfer'],
+            '  <' if r['size'] == tuned['transfer_size'] else ''))
+
+# groups word addresses into (start, count) runs of consecutive words, at most `maxwords` long
+def word_runs(addrs, maxwords):
+    runs = []
+    for addr in sorted(set(addrs)):
+        if len(runs) > 0 and runs[-1][0] + runs[-1][1] * 4 == addr and runs[-1][1] < maxwords:
+            runs[-1][1] += 1
+        else:
+            runs.append([addr, 1])
+    return runs
+
+def write_snapshot(fname, pc_usb):
+    registers = pc_usb.snapshot()
+    with open(fname, "w") as f:
+        json.dump({
+            'device': device_name(pc_usb.dev),
+            'gitrev': pc_usb.gitrev,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'registers': registers,
+        }, f, indent=2)
+        f.write('\n')
+    print("Saved {} registers to {}".format(len(registers), fname))
+
+# prints the registers that differ between two --snapshot files; returns how many do
+def diff_snapshots(old_fname, new_fname):
+    with open(old_fname, "r") as f:
+        old = json.load(f)
+    with open(new_fname, "r") as f:
+        new = json.load(f)
+    if old['gitrev'] != new['gitrev']:
+        print("Note: snapshots are of different SoC revisions ({} and {})".format(old['gitrev'], new['gitrev']))
+    (before, after) = (old['registers'], new['registers'])
+    changed = 0
+    for name in sorted(set(before) | set(after)):
+        if before.get(name) != after.get(name):
+            print("{:40} {:>18} -> {}".format(name, before.get(name, '-'), after.get(name, '-')))
+            changed += 1
+    print("{} of {} registers differ".format(changed, len(set(before) | set(after))))
+    return changed
+
+# FLASH offsets and lengths in manifests and on the command line may be ints or strings like "0x1000"
+def plan_number(x):
+    if isinstance(x, int):
+        return x
+    return int(x, 0)
+
+# An ordered list of FLASH updates -- images to burn and regions to erase -- that is checked as a
+# whole before the device is touched, then run back to back with a single flash ID check inside
+# the caller's halt window. Steps run in the order they were added.
+class UpdatePlan:
+    # `interactive` is cleared when several devices are updated at once, since their prompts
+    # would all be fighting over one console
+    def __init__(self, locs, flash_len, interactive=True):
+        self.locs = locs
+        self.flash_len = flash_len
+        self.interactive = interactive
+        self.steps = []
+
+    # a layout region ends where the next LOC_* begins (the audio clip has its own LEN_AUDIO)
+    def region_end(self, addr):
+        ends = [loc for (key, (loc, _)) in self.locs.items() if key.startswith('LOC_') and loc > addr]
+        if 'LEN_AUDIO' in self.locs and addr == self.locs['LOC_AUDIO'][0]:
+            ends.append(addr + self.locs['LEN_AUDIO'][0])
+        return min(ends + [self.flash_len])
+
+    # Returns (addr, limit) for a LOC_* name, which keeps the step inside that region of the
+    # layout, or for a plain FLASH offset, which only has to stay inside FLASH
+    def resolve(self, location):
+        if isinstance(location, str) and location.startswith('LOC_') and location in self.locs:
+            addr = self.locs[location][0]
+            return (addr, self.region_end(addr))
+        return (plan_number(location), self.flash_len)
+
+    # the name of the layout region that FLASH offset `addr` falls in
+    def region_of(self, addr):
+        regions = [(loc, key) for (key, (loc, _)) in self.locs.items() if key.startswith('LOC_') and loc <= addr]
+        return max(regions)[1] if len(regions) > 0 else None
+
+    def add_image(self, name, location, path, verify=True, delta=False):
+        (addr, limit) = self.resolve(location)
+        try:
+            length = os.stat(path).st_size
+        except OSError as e:
+            print("Can't use {} for the {}: {}".format(path, name, e))
+            exit(1)
+        self.steps.append({'kind': 'program', 'name': name, 'addr': addr, 'length': length, 'limit': limit,
+                           'parts': [(0, path)], 'verify': verify, 'delta': delta})
+
+    def add_erase(self, name, location, length):
+        (addr, limit) = self.resolve(location)
+        self.steps.append({'kind': 'erase', 'name': name, 'addr': addr, 'length': plan_number(length), 'limit': limit})
+
+    # Burning the SoC gateware overwrites the keys in the device, so it has to be confirmed (or
+    # forced), and the PDDB root structures go with it. The gateware can't be read back to verify.
+    # The staging area gets the same warning as --staging, but is left to `verify`.
+    def add_soc(self, name, location, path, verify, force):
+        confirmed = force
+        if not confirmed and not self.interactive:
+            print("Programming the SoC on several devices can't be confirmed interactively, use --force")
+            exit(1)
+        if not confirmed:
+            print("This will overwrite any secret keys in your device and erase PDDB keys. Continue? (y/n)")
+            confirm = input()
+            confirmed = len(confirm) > 0 and confirm.lower()[:1] == 'y'
+        if not confirmed:
+            return
+        if verify == True:
+            print("Note: SoC verification is not possible as readback is locked for security purposes")
+        self.add_image(name, location, path, verify=False)
+        self.add_erase("PDDB root structures", 'LOC_PDDB', 1024 * 1024)
+
+    def add_staging(self, name, location, path, verify):
+        if verify == True:
+            print("Note: staging area verification is not possible as readback is locked for security purposes")
+        self.add_image(name, location, path, verify=verify)
+
+    # A manifest is a JSON list of steps, for example
+    #   [{"image": "xous.img", "to": "LOC_KERNEL"},
+    #    {"image": "ec_fw.bin", "to": "0x07FCE000", "verify": false},
+    #    {"erase": "LOC_PDDB", "length": "0x100000"}]
+    # Image paths are relative to the manifest. verify and delta default to the command line's.
+    # Images going into the SoC or staging regions follow the same rules as --soc and --staging.
+    def load_manifest(self, fname, verify, delta, force):
+        try:
+            with open(fname, "r") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print("Can't read manifest {}: {}".format(fname, e))
+            exit(1)
+        if not isinstance(entries, list):
+            print("Manifest {} is not a list of steps".format(fname))
+            exit(1)
+        base = os.path.dirname(os.path.abspath(fname))
+        for entry in entries:
+            if not isinstance(entry, dict):
+                print("Manifest entry {} is not an object".format(entry))
+                exit(1)
+            if 'image' in entry:
+                required = 'to'
+            elif 'erase' in entry:
+                required = 'length'
+            else:
+                print("Manifest entry {} has neither an image nor an erase".format(entry))
+                exit(1)
+            if required not in entry:
+                print("Manifest entry {} has no '{}'".format(entry, required))
+                exit(1)
+            try:
+                if 'image' in entry:
+                    path = os.path.join(base, entry['image'])
+                    (addr, _) = self.resolve(entry['to'])
+                else:
+                    self.resolve(entry['erase'])
+                    plan_number(entry['length'])
+            except (TypeError, ValueError):
+                print("Manifest entry {} needs an image path, and locations and lengths that are numbers or LOC_* names".format(entry))
+                exit(1)
+
+            if 'erase' in entry:
+                self.add_erase(entry.get('name', 'region at {}'.format(entry['erase'])), entry['erase'], entry['length'])
+                continue
+            name = entry.get('name', entry['image'])
+            region = self.region_of(addr)
+            if region == 'LOC_SOC':
+                self.add_soc(name, entry['to'], path, entry.get('verify', verify), force)
+            elif region == 'LOC_STAGING':
+                self.add_staging(name, entry['to'], path, entry.get('verify', verify))
+            else:
+                self.add_image(name, entry['to'], path, verify=entry.get('verify', verify), delta=entry.get('delta', delta))
+
+    # Checks every step against FLASH and the layout, merges images that share a 4 KiB sector
+    # with the one before them (burning them separately would have the second one's erase wipe
+    # the tail of the first), and checks that no step undoes an earlier burn. Returns a list of
+    # problems; the plan is only good to run if it's empty.
+    def check(self):
+        problems = []
+        for step in self.steps:
+            if step['addr'] < 0 or step['addr'] + step['length'] > step['limit']:
+                problems.append("{}: 0x{:x} bytes at 0x{:08x} run past 0x{:08x}".format(
+                    step['name'], step['length'], step['addr'], step['limit']))
+
+        merged = []
+        for step in self.steps:
+            prev = merged[-1] if len(merged) > 0 else None
+            if (prev is not None and step['kind'] == 'program' and prev['kind'] == 'program'
+                    and prev['verify'] == step['verify'] and prev['delta'] == step['delta']
+                    and prev['addr'] + prev['length'] <= step['addr']
+                    and step['addr'] & ~0xFFF < (prev['addr'] + prev['length'] + 0xFFF) & ~0xFFF):
+                offset = step['addr'] - prev['addr']
+                prev['parts'] += [(offset + part_offset, path) for (part_offset, path) in step['parts']]
+                prev['length'] = offset + step['length']
+                prev['name'] += ' + ' + step['name']
+                continue
+            merged.append(dict(step))
+        self.steps = merged
+
+        for (i, earlier) in enumerate(self.steps):
+            if earlier['kind'] != 'program':
+                continue
+            for later in self.steps[i + 1:]:
+                if (later['addr'] & ~0xFFF < (earlier['addr'] + earlier['length'] + 0xFFF) & ~0xFFF
+                        and earlier['addr'] & ~0xFFF < (later['addr'] + later['length'] + 0xFFF) & ~0xFFF):
+                    problems.append("{} would overwrite {}".format(later['name'], earlier['name']))
+        return problems
+
+    # Rough seconds for each step: the datasheet typical erase times, about ten transfers of
+    # handshaking and polling per erase, about seven small transfers per 256-byte page, and
+    # pc_usb.transfer_ms per burst of readback.
+    def estimate(self, pc_usb):
+        small = 0.001 # a short control transfer takes about one full-speed frame
+        ops = {0x1000: 'se', 0x8000: 'be32', 0x1_0000: 'be'}
+        times = []
+        for step in self.steps:
+            secs = sum(pc_usb.TIMING[ops[size]][0] + 10 * small for (_, size) in pc_usb.erase_plan(step['addr'], step['length']))
+            if step['kind'] == 'program':
+                secs += (step['length'] + 255) // 256 * 7 * small
+                if step['verify']:
+                    secs += (step['length'] + pc_usb.transfer_size - 1) // pc_usb.transfer_size * pc_usb.transfer_ms / 1000
+            times.append(secs)
+        return times
+
+    def print_summary(self, pc_usb):
+        times = self.estimate(pc_usb)
+        print("Update plan:")
+        for (step, secs) in zip(self.steps, times):
+            print("  {:7} 0x{:08x}-0x{:08x} ~{:6.1f}s  {}".format(step['kind'], step['addr'], step['addr'] + step['length'], secs, step['name']))
+        print("Estimated time: about {:.0f}s".format(sum(times)))
+
+    def run(self, pc_usb):
+        pc_usb.flash_check_id()
+        for step in self.steps:
+            if step['kind'] == 'erase':
+                print("Erasing {}".format(step['name']))
+                pc_usb.erase_region(step['addr'], step['length'], check_id=False)
+                continue
+            print("Programming {}".format(step['name']))
+            if len(step['parts']) == 1:
+                image = step['parts'][0][1]
+            else:
+                # merged neighbours go out as one image, with the gap between them left erased
+                image = bytearray(b'\xff') * step['length']
+                for (offset, path) in step['parts']:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                    image[offset:offset + len(data)] = data
+            pc_usb.flash_program(step['addr'], image, verify=step['verify'], delta=step['delta'], check_id=False)
+
 def auto_int(x):
     return int(x, 0)
 
+# flash_program takes raw bytes, a path, an open file or an mmap. Files are mapped rather
+# than read in, so however large the image is, the page loop only slices a memoryview of it.
+@contextlib.contextmanager
+def open_image(image):
+    if isinstance(image, (str, os.PathLike)):
+        with open(image, "rb") as f:
+            with open_image(f) as view:
+                yield view
+        return
+    if hasattr(image, 'read'):
+        mapped = None
+        try:
+            st = os.fstat(image.fileno())
+            if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+                mapped = mmap.mmap(image.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError, io.UnsupportedOperation):
+            pass
+        if mapped is None:
+            # pipes, sockets and HTTP responses can't be mapped
+            with memoryview(image.read()) as view:
+                yield view
+            return
+        try:
+            with memoryview(mapped) as view:
+                yield view
+        finally:
+            try:
+                mapped.close()
+            except BufferError:
+                pass # a slice outlived the update (e.g. held by a traceback); let gc unmap it
+        return
+    with memoryview(image) as view:
+        yield view.cast('B')
+
+# line-oriented stand-in for ProgressBar that prints every `step` percent
+class StepProgress:
+    def __init__(self, max_value, prefix, step=10):
+        self.max_value = max(max_value, 1)
+        self.prefix = prefix
+        self.step = step
+        self.next = step
+
+    def start(self):
+        print("{}0%".format(self.prefix))
+        return self
+
+    def update(self, value):
+        percent = value * 100 // self.max_value
+        if percent >= self.next:
+            print("{}{}%".format(self.prefix, percent))
+            self.next = (percent // self.step + 1) * self.step
+
+    def finish(self):
+        print("{}100%".format(self.prefix))
+
+# Dumps [addr, addr+length) of FLASH to `fname`: compressed as it streams if the name ends in .gz
+# or .xz, otherwise as a sparse file with holes for the erased sectors. The erased runs and the
+# SHA-256 of the real contents are written next to it, in `fname`.json.
+def dump_flash(pc_usb, addr, length, fname):
+    if fname.endswith('.gz'):
+        import gzip
+        (out, sparse) = (gzip.open(fname, "wb"), False)
+    elif fname.endswith('.xz'):
+        import lzma
+        (out, sparse) = (lzma.open(fname, "wb"), False)
+    else:
+        (out, sparse) = (open(fname, "wb"), True)
+    print("Dumping 0x{:x} bytes of FLASH from 0x{:08x} to {}".format(length, addr, fname))
+    with out:
+        (erased, digest) = pc_usb.flash_dump(addr, length, out, sparse=sparse)
+    blank = sum(run_len for (offset, run_len) in erased)
+    with open(fname + '.json', "w") as f:
+        json.dump({
+            'addr': addr,
+            'length': length,
+            'gitrev': pc_usb.gitrev,
+            'sha256': digest,
+            'sparse': sparse,
+            'erased': erased,
+        }, f, indent=2)
+        f.write('\n')
+    print("{} bytes in use, {} erased, sha256 {}".format(length - blank, blank, digest))
+
+# One request of the --session line protocol; returns the reply line. Numbers may be given in
+# any base int() understands, data is hex, and FLASH addresses are relative to its bottom:
+#   peek ADDR                -> ok 0xVALUE
+#   poke ADDR VALUE          -> ok
+#   read ADDR LEN            -> ok HEXDATA
+#   write ADDR HEXDATA       -> ok
+#   halt | unhalt | ping     -> ok
+#   erase ADDR LEN           -> ok
+#   program ADDR FILE [verify] -> ok
+# erase and program are refused until the CPU has been halted, so that the firmware isn't driving
+# the SPINOR controller at the same time. Anything that fails gets "err MESSAGE" instead.
+def session_command(pc_usb, words):
+    (cmd, args) = (words[0], words[1:])
+    if cmd == 'peek' and len(args) == 1:
+        return 'ok 0x{:08x}'.format(pc_usb.peek(int(args[0], 0)))
+    if cmd == 'poke' and len(args) == 2:
+        pc_usb.poke(int(args[0], 0), int(args[1], 0))
+    elif cmd == 'read' and len(args) == 2:
+        return 'ok ' + pc_usb.burst_read(int(args[0], 0), int(args[1], 0)).hex()
+    elif cmd == 'write' and len(args) == 2:
+        pc_usb.burst_write(int(args[0], 0), bytes.fromhex(args[1]), in_place=True)
+    elif cmd == 'halt' and len(args) == 0:
+        pc_usb.halt()
+    elif cmd == 'unhalt' and len(args) == 0:
+        pc_usb.unhalt()
+    elif cmd == 'ping' and len(args) == 0:
+        pc_usb.ping_wdt()
+    elif cmd in ('erase', 'program') and not pc_usb.halted:
+        return 'err halt the CPU before {}'.format(cmd)
+    elif cmd == 'erase' and len(args) == 2:
+        pc_usb.erase_region(int(args[0], 0), int(args[1], 0))
+    elif cmd == 'program' and len(args) in (2, 3) and args[2:] in ([], ['verify']):
+        with open(args[1], "rb") as f:
+            pc_usb.flash_program(int(args[0], 0), f, verify=len(args) == 3)
+    else:
+        return 'err unknown request: ' + ' '.join(words)
+    return 'ok'
+
+# Serves session_command over `requests`/`replies` (line-oriented text streams) until EOF or
+# "quit". The progress and status output of the requests goes to `log`.
+def serve_session_stream(pc_usb, requests, replies, log, lock):
+    for line in requests:
+        words = line.split()
+        if len(words) == 0:
+            continue
+        if words == ['quit']:
+            replies.write('ok\n')
+            replies.flush()
+            return False
+        if words == ['shutdown']:
+            replies.write('ok\n')
+            replies.flush()
+            return True
+        try:
+            with lock, contextlib.redirect_stdout(log):
+                reply = session_command(pc_usb, words)
+        except SystemExit as e:
+            reply = 'err exited with {}'.format(e.code)
+        except Exception as e:
+            # a bad request mustn't take the server down, least of all with the CPU halted
+            reply = 'err {}'.format(e)
+        replies.write(reply + '\n')
+        replies.flush()
+    return False
+
+# Feeds the watchdog from a background thread for as long as the session is open, so that a
+# client that halts the CPU and then goes quiet doesn't have the SoC reset under it. Requests
+# hold the lock this yields, so the pings never land in the middle of one.
+@contextlib.contextmanager
+def session_keepalive(pc_usb):
+    lock = threading.Lock()
+    stop = threading.Event()
+    def run():
+        while not stop.wait(max(pc_usb.wdt_interval / 2, 0.05)):
+            with lock:
+                try:
+                    pc_usb.keepalive()
+                except usb.core.USBError as e:
+                    print("Watchdog ping failed: {}".format(e), file=sys.stderr)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        yield lock
+    finally:
+        stop.set()
+        thread.join()
+
+# Keeps one PrecursorUsb open and serves requests from stdin (`path` of '-') or, one client at
+# a time, from a Unix socket at `path`; "shutdown" from a socket client stops the server.
+def serve_session(pc_usb, path):
+    with session_keepalive(pc_usb) as lock:
+        return serve_session_requests(pc_usb, path, lock)
+
+def serve_session_requests(pc_usb, path, lock):
+    import socket
+    pc_usb.quiet_progress = True
+    if path == '-':
+        # read from a copy of stdin: the exit() that failing requests bail out with closes sys.stdin
+        with open(os.dup(sys.stdin.fileno()), "r") as requests:
+            serve_session_stream(pc_usb, requests, sys.stdout, sys.stderr, lock)
+        return 0
+    if os.path.lexists(path):
+        # only clear away a socket left behind by an earlier session, never some other file
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            print("{} exists and is not a socket, not serving a session there".format(path))
+            return 1
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(path)
+        server.listen(1)
+        print("Serving session requests on {}".format(path))
+        while True:
+            (conn, _) = server.accept()
+            with conn, conn.makefile('r') as requests, conn.makefile('w') as replies:
+                if serve_session_stream(pc_usb, requests, replies, sys.stdout, lock):
+                    return 0
+    finally:
+        server.close()
+        os.unlink(path)
+
+# replaces sys.stdout while several devices are updated at once: output from each
+# worker thread gets its device name as a line prefix, and is copied to its log file
+class ThreadOutput:
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def attach(self, name, log=None):
+        self.local.name = name
+        self.local.log = log
+        self.local.partial = ''
+
+    def detach(self):
+        if getattr(self.local, 'partial', '') != '':
+            self.write('\n')
+        self.local.name = None
+
+    def write(self, s):
+        name = getattr(self.local, 'name', None)
+        if name is None:
+            with self.lock:
+                return self.stream.write(s)
+        lines = (self.local.partial + s).split('\n')
+        self.local.partial = lines.pop()
+        with self.lock:
+            for line in lines:
+                self.stream.write("[{}] {}\n".format(name, line))
+        if self.local.log is not None:
+            for line in lines:
+                self.local.log.write(line + '\n')
+        return len(s)
+
+    def flush(self):
+        with self.lock:
+            self.stream.flush()
+
+def write_report(fname, reports):
+    with open(fname, "w") as f:
+        json.dump({'devices': reports}, f, indent=2)
+        f.write('\n')
+
+# SET_CONFIGURATION costs a round trip and resets the device's endpoints, so skip it when the
+# device already has an active configuration
+def ensure_configured(dev):
+    try:
+        dev.get_active_configuration()
+    except usb.core.USBError:
+        dev.set_configuration()
+
+def device_name(dev):
+    if dev.port_numbers:
+        return "{}-{}".format(dev.bus, '.'.join(str(p) for p in dev.port_numbers))
+    return "{}-{}".format(dev.bus, dev.address)
+
+def device_serial(dev):
+    try:
+        return dev.serial_number
+    except (ValueError, usb.core.USBError):
+        return None
+
+# every attached Precursor, optionally narrowed down to the given bus-port names and serials
+def find_devices(names=None, serials=None):
+    devs = []
+    for dev in usb.core.find(find_all=True, idProduct=0x5bf0, idVendor=0x1209):
+        if names and device_name(dev) not in names:
+            continue
+        if serials and device_serial(dev) not in serials:
+            continue
+        devs.append(dev)
+    return sorted(devs, key=device_name)
+
+# Resets the SoC and waits up to `timeout` seconds for the device to enumerate again on the same
+# bus-port (or, where the port isn't known, with the same serial on the same bus). Returns a
+# PrecursorUsb for it with the CSRs loaded and the settings and statistics of `pc_usb` carried
+# over, or None if it didn't come back in time.
+def reconnect(pc_usb, timeout=30.0, use_cache=True):
+    name = device_name(pc_usb.dev)
+    # the same device comes back under a new USB address, which tells it apart from the old one
+    # in case that is still listed
+    address = pc_usb.dev.address
+    # without port numbers the name is bus-address, which changes on re-enumeration
+    (bus, serial) = (pc_usb.dev.bus, device_serial(pc_usb.dev))
+    pc_usb.reset_soc()
+    usb.util.dispose_resources(pc_usb.dev)
+    start = pc_usb.clock()
+    interval = 0.1
+    while pc_usb.clock() - start < timeout:
+        pc_usb.sleep(interval)
+        interval = min(interval * 2, 1.0)
+        if pc_usb.dev.port_numbers:
+            devs = find_devices([name])
+        else:
+            devs = [dev for dev in find_devices(serials=[serial]) if dev.bus == bus]
+        devs = [dev for dev in devs if dev.address != address]
+        if len(devs) == 0:
+            continue
+        try:
+            devs[0].set_configuration()
+        except usb.core.USBError:
+            continue # still enumerating
+        fresh = PrecursorUsb(devs[0])
+        for attr in ('poll_timeout', 'verify_sample', 'verify_seed', 'resume', 'quiet_progress',
+                     'transfer_size', 'transfer_timeout', 'transfer_ms', 'wdt_interval', 'clock', 'sleep',
+                     'stats', 'poll_stats'):
+            setattr(fresh, attr, getattr(pc_usb, attr))
+        fresh.load_csrs(use_cache=use_cache)
+        return fresh
+    return None
+
+# resumes the CPU and resets the SoC; with --bounce, waits for the device to come back and
+# returns the new PrecursorUsb
+def restart(pc_usb, args):
+    print("Resuming CPU.")
+    pc_usb.unhalt()
+    if not args.bounce:
+        print("Resetting SOC...")
+        pc_usb.reset_soc()
+        return None
+    print("Resetting SOC and waiting for {} to come back...".format(device_name(pc_usb.dev)))
+    fresh = reconnect(pc_usb, args.reconnect_timeout, use_cache=not args.no_csr_cache)
+    if fresh == None:
+        print("Device didn't come back within {:.0f}s".format(args.reconnect_timeout))
+        exit(1)
+    print("Device is back, running SoC {}".format(fresh.gitrev))
+    return fresh
+
+# runs the same update on every device in its own thread; returns the process exit code
+def update_all(devs, args):
+    if args.soc != None and args.force == False:
+        print("Programming --soc on several devices can't be confirmed interactively, use --force")
+        return 1
+    if args.log_dir != None:
+        os.makedirs(args.log_dir, exist_ok=True)
+
+    output = ThreadOutput(sys.stdout)
+    results = {}
+    reports = {}
+
+    def worker(dev):
+        name = device_name(dev)
+        log = None
+        if args.log_dir != None:
+            log = open(os.path.join(args.log_dir, name + '.log'), 'w')
+        output.attach(name, log)
+        start = time.monotonic()
+        passed = False
+        try:
+            dev.set_configuration()
+            if args.config:
+                print(dev.get_active_configuration())
+            pc_usb = PrecursorUsb(dev)
+            pc_usb.quiet_progress = True
+            reports[name] = pc_usb.report
+            update_device(pc_usb, args)
+            passed = True
+        except SystemExit as e:
+            # the update paths bail out with exit(); treat that as this device's result only
+            passed = e.code == None or e.code == 0
+        except Exception as e:
+            print("Failed: {!r}".format(e))
+        results[name] = (passed, time.monotonic() - start)
+        print("PASS" if passed else "FAIL")
+        output.detach()
+        if log is not None:
+            log.close()
+
+    print("Updating {} devices: {}".format(len(devs), ', '.join(device_name(d) for d in devs)))
+    sys.stdout = output
+    try:
+        threads = [threading.Thread(target=worker, args=(dev,), name=device_name(dev)) for dev in devs]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        sys.stdout = output.stream
+
+    if args.report != None:
+        write_report(args.report, {name: report() for (name, report) in reports.items()})
+
+    failed = 0
+    for (name, (passed, elapsed)) in sorted(results.items()):
+        print("  {}: {} in {:.1f}s".format(name, "PASS" if passed else "FAIL", elapsed))
+        if not passed:
+            failed += 1
+    print("{} of {} devices passed".format(len(results) - failed, len(results)))
+    return 0 if failed == 0 else 1
+
 def main():
     parser = argparse.ArgumentParser(description="Update/upload to a Precursor device running Xous 0.8/0.9")
     parser.add_argument(
@@ -484,17 +2143,89 @@ def main():
         "-i", "--image", required=False, help="Manually specify an image and address. Offset is relative to bottom of flash.", type=str, nargs=2, metavar=('IMAGEFILE', 'ADDR')
     )
     parser.add_argument(
-        "--verify", help="Readback verification. May fail for large files due to WDT timeout.", default=False, action='store_true'
+        "--dump", required=False, help="Save LEN bytes of FLASH from ADDR (relative to bottom of flash) to FILE. FILE is compressed if it ends in .gz or .xz, and sparse otherwise.", type=str, nargs=3, metavar=('ADDR', 'LEN', 'FILE')
+    )
+    parser.add_argument(
+        "--dump-flash", required=False, help="Save the whole FLASH to FILE, as with --dump", type=str, metavar=('FILE')
+    )
+    parser.add_argument(
+        "--manifest", required=False, help="JSON list of images to burn and regions to erase, run after any images given on the command line", type=str, metavar=('FILE')
+    )
+    parser.add_argument(
+        "--verify", help="Readback verification, done block by block as the image is programmed.", default=False, action='store_true'
+    )
+    parser.add_argument(
+        "--verify-sample", required=False, help="Sampled readback verification: check about this fraction of each block's pages (always its first and last), and the whole block if any sampled page is wrong", type=float, metavar=('FRACTION')
+    )
+    parser.add_argument(
+        "--verify-seed", required=False, help="Seed for choosing the --verify-sample pages, to make a run repeatable", type=int, metavar=('SEED')
+    )
+    parser.add_argument(
+        "--delta", help="Read back the target area first and only erase and program the 4 KiB sectors that changed", default=False, action='store_true'
+    )
+    parser.add_argument(
+        "--wdt-interval", help="Seconds between watchdog pings while the device is being worked on (default 0.5)", type=float, default=0.5, metavar=('SECONDS')
+    )
+    parser.add_argument(
+        "--resume", help="Continue an interrupted image burn from the first block its progress journal doesn't record as done", action="store_true"
+    )
+    parser.add_argument(
+        "--poll-timeout", required=False, help="Seconds to wait for any single flash operation before giving up (default: twice the datasheet maximum)", type=float, metavar=('SECONDS')
     )
     parser.add_argument(
         "--force", help="Ignore gitrev version on SoC and try to burn an image anyways", action="store_true"
     )
     parser.add_argument(
-        "--bounce", help="cycle the device through a reset", action="store_true"
+        "--bounce", help="cycle the device through a reset, and wait for it to come back before exiting", action="store_true"
+    )
+    parser.add_argument(
+        "--reconnect-timeout", help="Seconds to wait for the device to come back after a --bounce reset (default 30)", type=float, default=30.0, metavar=('SECONDS')
     )
     parser.add_argument(
         "--factory-new", help="reset the entire image to mimic exactly what comes out of the factory, including temp files for testing. Warning: this will take a long time.", action="store_true"
     )
+    parser.add_argument(
+        "--factory-url", required=False, help="Where --factory-new fetches its images from", type=str, default="https://ci.betrusted.io/releases/v0.9.5/", metavar=('URL')
+    )
+    parser.add_argument(
+        "--mirror", required=False, help="Local mirror directory for --factory-new: images found there are used as-is, downloads are saved there", type=str, metavar=('DIR')
+    )
+    parser.add_argument(
+        "--factory-sums", required=False, help="sha256sum-style file the --factory-new images are checked against", type=str, metavar=('FILE')
+    )
+    parser.add_argument(
+        "--report", required=False, help="Write transfer counts, per-phase timing, status polling and per-image throughput to a JSON file", type=str, metavar=('FILE')
+    )
+    parser.add_argument(
+        "--all-devices", help="Update every attached Precursor in parallel", action="store_true"
+    )
+    parser.add_argument(
+        "--device", required=False, help="Only use the device on this bus-port path, as in /sys/bus/usb/devices (e.g. 1-1.3). May be repeated.", type=str, action='append', metavar=('BUS-PORT')
+    )
+    parser.add_argument(
+        "--serial", required=False, help="Only use the device with this USB serial number. May be repeated.", type=str, action='append', metavar=('SERIAL')
+    )
+    parser.add_argument(
+        "--log-dir", required=False, help="With several devices, also write each device's output to DIR/<bus-port>.log", type=str, metavar=('DIR')
+    )
+    parser.add_argument(
+        "--tune", help="Measure burst transfer throughput across transfer sizes and save the best for this host and gateware", action="store_true"
+    )
+    parser.add_argument(
+        "--show-tuning", help="Print the saved --tune results of every host and gateware revision", action="store_true"
+    )
+    parser.add_argument(
+        "--session", required=False, help="Keep the device open and serve peek/poke/read/write/halt/unhalt/erase/program requests, one per line, from stdin or the Unix socket at PATH", type=str, nargs='?', const='-', metavar=('PATH')
+    )
+    parser.add_argument(
+        "--snapshot", required=False, help="Save the value of every register in the CSR database to a JSON file", type=str, metavar=('FILE')
+    )
+    parser.add_argument(
+        "--snapshot-diff", required=False, help="Compare two --snapshot files and list the registers that differ", type=str, nargs=2, metavar=('OLD', 'NEW')
+    )
+    parser.add_argument(
+        "--no-csr-cache", help="Always read and parse the full csr.csv descriptor instead of using the on-disk cache", action="store_true"
+    )
     parser.add_argument(
         "--override-csr", required=False, help="CSR file to use instead of CSR values stored with the image. Used to recover in case of partial update of soc_csr.bin", type=str,
     )
@@ -504,22 +2235,70 @@ def main():
         print("No arguments specified, doing nothing. Use --help for more information.")
         exit(1)
 
-    dev = usb.core.find(idProduct=0x5bf0, idVendor=0x1209)
+    if args.snapshot_diff:
+        exit(0 if diff_snapshots(*args.snapshot_diff) == 0 else 1)
+
+    if args.show_tuning:
+        tunings = load_tunings(os.path.join(cache_dir(), 'tune.json'))
+        if len(tunings) == 0:
+            print("No saved tuning results")
+        for (key, tuned) in sorted(tunings.items()):
+            print_tuning(tuned)
+        exit(0)
+
+    # the read-only modes exit before any image is burned, so they can't share a run with one
+    images = [args.image, args.ec, args.wf200, args.staging, args.kernel, args.loader, args.soc, args.audiotest, args.manifest]
+    updating = (any(image != None for image in images) or args.erase_pddb or args.disable_boot
+                or args.enable_boot_wipe or args.enable_boot_update or args.factory_new)
+    if (args.dump or args.dump_flash) and updating:
+        print("--dump and --dump-flash can't be combined with updates; dump first, then update in a separate run")
+        exit(1)
+    if args.snapshot and updating:
+        print("--snapshot can't be combined with updates; take it first, then update in a separate run")
+        exit(1)
+
+    if args.all_devices or args.device != None or args.serial != None:
+        devs = find_devices(args.device, args.serial)
+        if len(devs) == 0:
+            print("No matching Precursor devices found")
+            exit(1)
+        if args.all_devices or len(devs) > 1:
+            if args.peek or args.poke:
+                print("--peek and --poke only work on a single device")
+                exit(1)
+            if args.dump or args.dump_flash:
+                # every device would be writing to the same file at once
+                print("--dump and --dump-flash only work on a single device")
+                exit(1)
+            if args.snapshot:
+                print("--snapshot only works on a single device")
+                exit(1)
+            exit(update_all(devs, args))
+        dev = devs[0]
+    else:
+        dev = usb.core.find(idProduct=0x5bf0, idVendor=0x1209)
 
     if dev is None:
         raise ValueError('Precursor device not found')
 
-    dev.set_configuration()
+    if (args.peek or args.poke) and not args.config:
+        # the lean path: no CSR database, and no SET_CONFIGURATION unless the device needs one
+        ensure_configured(dev)
+    else:
+        dev.set_configuration()
     if args.config:
         cfg = dev.get_active_configuration()
         print(cfg)
 
     pc_usb = PrecursorUsb(dev)
 
-    if args.verify:
-        verify = True
-    else:
-        verify = False
+    if args.session:
+        pc_usb.wdt_interval = args.wdt_interval
+        # on stdin/stdout, keep stdout for the replies
+        with contextlib.redirect_stdout(sys.stderr if args.session == '-' else sys.stdout):
+            pc_usb.load_csrs(args.override_csr, use_cache=not args.no_csr_cache)
+            pc_usb.load_tuning()
+        exit(serve_session(pc_usb, args.session))
 
     if args.peek:
         pc_usb.peek(args.peek, display=True)
@@ -540,7 +2319,29 @@ def main():
         #     print("match")
         exit(0)
 
-    pc_usb.load_csrs(args.override_csr) # prime the CSR values
+    try:
+        update_device(pc_usb, args)
+    finally:
+        if args.report != None:
+            write_report(args.report, {device_name(dev): pc_usb.report()})
+
+# everything after device selection: load the CSRs, then burn/erase whatever the arguments ask for
+def update_device(pc_usb, args):
+    pc_usb.poll_timeout = args.poll_timeout
+    pc_usb.verify_sample = args.verify_sample
+    pc_usb.verify_seed = args.verify_seed
+    pc_usb.resume = args.resume
+    pc_usb.wdt_interval = args.wdt_interval
+
+    if args.verify or args.verify_sample != None:
+        verify = True
+    else:
+        verify = False
+
+    pc_usb.load_csrs(args.override_csr, use_cache=not args.no_csr_cache) # prime the CSR values
+    if args.snapshot:
+        write_snapshot(args.snapshot, pc_usb)
+        exit(0)
     if "v0.8" in pc_usb.gitrev:
         locs = {
            "LOC_SOC"    : [0x0000_0000, "soc_csr.bin"],
@@ -582,10 +2383,62 @@ def main():
         print("SoC is from an unknow rev '{}', use --force to continue anyways with v0.9 firmware offsets".format(pc_usb.load_csrs()))
         exit(1)
 
+    if args.tune:
+        print("Measuring burst transfer throughput...")
+        tuned = pc_usb.tune_transfers(int(pc_usb.regions['spiflash'][0], 0) + locs['LOC_KERNEL'][0])
+        if tuned is not None:
+            print_tuning(tuned)
+        exit(0)
+    tuned = pc_usb.load_tuning()
+    if tuned is not None:
+        print("Using tuned {} byte transfers".format(tuned['transfer_size']))
+
+    # everything that burns an image goes into one plan, checked before the CPU is halted
+    # update_all runs each device in a worker thread
+    plan = UpdatePlan(locs, int(pc_usb.regions['spiflash'][1], 0), threading.current_thread() is threading.main_thread())
+    if not (args.enable_boot_wipe or args.enable_boot_update):
+        if args.image:
+            image_file, addr_str = args.image
+            plan.add_image("manually specified image '{}'".format(image_file), int(addr_str, 0), image_file, verify, args.delta)
+        if args.ec != None:
+            plan.add_image("EC firmware package '{}'".format(args.ec), 'LOC_EC', args.ec, verify, args.delta)
+        if args.wf200 != None:
+            plan.add_image("WF200 firmware package '{}'".format(args.wf200), 'LOC_WF200', args.wf200, verify, args.delta)
+        if args.staging != None:
+            plan.add_staging("staged SoC gateware {}".format(args.staging), 'LOC_STAGING', args.staging, verify)
+        if args.kernel != None:
+            plan.add_image("kernel image {}".format(args.kernel), 'LOC_KERNEL', args.kernel, verify, args.delta)
+        if args.loader != None:
+            plan.add_image("loader image {}".format(args.loader), 'LOC_LOADER', args.loader, verify, args.delta)
+        if args.soc != None:
+            plan.add_soc("SoC gateware {}".format(args.soc), 'LOC_SOC', args.soc, verify, args.force)
+        if args.audiotest != None:
+            plan.add_image("audio test clip {}".format(args.audiotest), 'LOC_AUDIO', args.audiotest, verify, args.delta)
+        if args.manifest != None:
+            plan.load_manifest(args.manifest, verify, args.delta, args.force)
+    problems = plan.check()
+    if len(problems) > 0:
+        for problem in problems:
+            print("Can't update: " + problem)
+        exit(1)
+    if len(plan.steps) > 0:
+        plan.print_summary(pc_usb)
+
     pc_usb.ping_wdt()
     print("Halting CPU.")
     pc_usb.halt()
 
+    if args.dump or args.dump_flash:
+        if args.dump:
+            (addr_str, len_str, fname) = args.dump
+            dump_flash(pc_usb, int(addr_str, 0), int(len_str, 0), fname)
+        if args.dump_flash:
+            dump_flash(pc_usb, 0, int(pc_usb.regions['spiflash'][1], 0), args.dump_flash)
+        pc_usb.stats.print_summary()
+        print("Resuming CPU.")
+        pc_usb.unhalt()
+        exit(0)
+
     if args.erase_pddb:
         print("Erasing PDDB region")
         pc_usb.erase_region(locs['LOC_PDDB'][0], locs['LOC_EC'][0] - locs['LOC_PDDB'][0])
@@ -602,26 +2455,17 @@ def main():
         print("Enabling boot with {} and {}".format(args.loader, args.soc))
         print("Programming loader image {}".format(args.loader))
         with open(args.loader, "rb") as f:
-            image = f.read()
-            pc_usb.flash_program(locs['LOC_LOADER'][0], image, verify=verify)
+            pc_usb.flash_program(locs['LOC_LOADER'][0], f, verify=verify, delta=args.delta)
         print("Programming SoC gateware".format(args.soc))
         with open(args.soc, "rb") as f:
-            image = f.read()
             if verify == True:
                 print("Note: SoC verification is not possible as readback is locked for security purposes")
-            pc_usb.flash_program(locs['LOC_SOC'][0], image, verify=False)
+            pc_usb.flash_program(locs['LOC_SOC'][0], f, verify=False)
 
         print("Erasing PDDB root structures")
         pc_usb.erase_region(locs['LOC_PDDB'][0], 1024 * 1024)
 
-        print("Resuming CPU.")
-        pc_usb.unhalt()
-
-        print("Resetting SOC...")
-        try:
-            pc_usb.poke(pc_usb.register('reboot_soc_reset'), 0xac, display=False)
-        except usb.core.USBError:
-            pass # we expect an error because we reset the SOC and that includes the USB core
+        restart(pc_usb, args)
         exit(0)
 
     if args.enable_boot_update:
@@ -632,122 +2476,28 @@ def main():
         print("Enabling boot with {} and {}".format(args.loader, args.staging))
         print("Programming loader image {}".format(args.loader))
         with open(args.loader, "rb") as f:
-            image = f.read()
-            pc_usb.flash_program(locs['LOC_LOADER'][0], image, verify=verify)
+            pc_usb.flash_program(locs['LOC_LOADER'][0], f, verify=verify, delta=args.delta)
         print("Staging SoC gateware".format(args.staging))
         with open(args.staging, "rb") as f:
-            image = f.read()
             if verify == True:
                 print("Note: staging area verification is not possible as readback is locked for security purposes")
-            pc_usb.flash_program(locs['LOC_STAGING'][0], image, verify=verify)
+            pc_usb.flash_program(locs['LOC_STAGING'][0], f, verify=verify)
 
-        print("Resuming CPU.")
-        pc_usb.unhalt()
-
-        print("Resetting SOC...")
-        try:
-            pc_usb.poke(pc_usb.register('reboot_soc_reset'), 0xac, display=False)
-        except usb.core.USBError:
-            pass # we expect an error because we reset the SOC and that includes the USB core
+        restart(pc_usb, args)
         exit(0)
 
-    if args.image:
-        image_file, addr_str = args.image
-        addr = int(addr_str, 0)
-        print("Burning manually specified image '{}' to address 0x{:08x} relative to bottom of FLASH".format(image_file, addr))
-        with open(image_file, "rb") as f:
-            image_data = f.read()
-            pc_usb.flash_program(addr, image_data, verify=verify)
-
-    if args.ec != None:
-        print("Staging EC firmware package '{}' in SOC memory space...".format(args.ec))
-        with open(args.ec, "rb") as f:
-            image = f.read()
-            pc_usb.flash_program(locs['LOC_EC'][0], image, verify=verify)
-
-    if args.wf200 != None:
-        print("Staging WF200 firmware package '{}' in SOC memory space...".format(args.wf200))
-        with open(args.wf200, "rb") as f:
-            image = f.read()
-            pc_usb.flash_program(locs['LOC_WF200'][0], image, verify=verify)
-
-    if args.staging != None:
-        print("Staging SoC gateware {}".format(args.soc))
-        with open(args.staging, "rb") as f:
-            image = f.read()
-            if verify == True:
-                print("Note: staging area verification is not possible as readback is locked for security purposes")
-            pc_usb.flash_program(locs['LOC_STAGING'][0], image, verify=verify)
-
-    if args.kernel != None:
-        print("Programming kernel image {}".format(args.kernel))
-        with open(args.kernel, "rb") as f:
-            image = f.read()
-            pc_usb.flash_program(locs['LOC_KERNEL'][0], image, verify=verify)
-
-    if args.loader != None:
-        print("Programming loader image {}".format(args.loader))
-        with open(args.loader, "rb") as f:
-            image = f.read()
-            pc_usb.flash_program(locs['LOC_LOADER'][0], image, verify=verify)
-
-    if args.soc != None:
-        if args.force == True:
-            print("Programming SoC gateware {}".format(args.soc))
-            with open(args.soc, "rb") as f:
-                image = f.read()
-                if verify == True:
-                    print("Note: SoC verification is not possible as readback is locked for security purposes")
-                pc_usb.flash_program(locs['LOC_SOC'][0], image, verify=False)
-                print("Erasing PDDB root structures")
-                pc_usb.erase_region(locs['LOC_PDDB'][0], 1024 * 1024)
-        else:
-            print("This will overwrite any secret keys in your device and erase PDDB keys. Continue? (y/n)")
-            confirm = input()
-            if len(confirm) > 0 and confirm.lower()[:1] == 'y':
-                print("Programming SoC gateware {}".format(args.soc))
-                with open(args.soc, "rb") as f:
-                    image = f.read()
-                    if verify == True:
-                        print("Note: SoC verification is not possible as readback is locked for security purposes")
-                    pc_usb.flash_program(locs['LOC_SOC'][0], image, verify=False)
-                    print("Erasing PDDB root structures")
-                    pc_usb.erase_region(locs['LOC_PDDB'][0], 1024 * 1024)
-
-
-    if args.audiotest != None:
-        print("Loading audio test clip {}".format(args.audiotest))
-        with open(args.audiotest, "rb") as f:
-            image = f.read()
-            if len(image) >= locs['LEN_AUDIO'][0]:
-                print("audio file is too long, aborting audio burn!")
-            else:
-                pc_usb.flash_program(locs['LOC_AUDIO'][0], image, verify=verify)
+    if len(plan.steps) > 0:
+        plan.run(pc_usb)
 
     if args.factory_new:
-        base_url = "https://ci.betrusted.io/releases/v0.9.5/"
-        # erase the entire flash
-        pc_usb.erase_region(0, 0x800_0000)
-        # burn the gateware
-        for sections in locs.values():
-            if sections[1] != 'pass':
-                print('retrieving {}'.format(base_url + sections[1]))
-                with urllib.request.urlopen(base_url + sections[1]) as f:
-                    print('burning at {:x}'.format(sections[0]))
-                    image = f.read()
-                    pc_usb.flash_program(sections[0], image, verify=False)
+        factory_new(pc_usb, locs, args)
 
+    if len(pc_usb.poll_stats) > 0:
+        print("Flash status polling:")
+        pc_usb.print_poll_stats()
+    pc_usb.stats.print_summary()
 
-    print("Resuming CPU.")
-    pc_usb.unhalt()
-
-    print("Resetting SOC...")
-    try:
-        pc_usb.poke(pc_usb.register('reboot_soc_reset'), 0xac, display=False)
-    except usb.core.USBError:
-        pass # we expect an error because we reset the SOC and that includes the USB core
-
-    # print("If you need to run more commands, please unplug and re-plug your device in, as the Precursor USB core was just reset")
+    restart(pc_usb, args)
 
 if __name__ == "__main__":
     main()